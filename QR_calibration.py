@@ -0,0 +1,131 @@
+""" Quantile calibration table of any QR U-Net on any stacked dataset
+
+Replaces the per-dataset QR_performance_evaluation_*.py loops: the model is run over
+the data in batches, every batch is added to a CalibrationAccumulator, and the
+expected vs observed positive rate of each quantile bin is printed (and optionally
+saved as JSON).
+
+    python QR_calibration.py --model LIDC_AAJ_4Q.pth --arch qrunet_4q --data test.npz
+    python QR_calibration.py --model ISLE_QR_fulldata.pth --arch qrunet --channels 3 \
+        --quantiles 0.75 0.5 0.25 --data data_24_ISEL_100.npz
+"""
+
+import argparse
+import json
+import logging
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from evaluate import grayscale_batch, isle_batch, net_output, stacked_output
+from unet import QRUNet, QRUNet_4Q, QRUNetN
+from unet.unet_model import default_quantiles
+from util.calibration import CalibrationAccumulator
+from util.data_loading import PackedDataset
+from tqdm import tqdm
+
+architectures = {
+    'qrunet': (QRUNet, 3),
+    'qrunet_4q': (QRUNet_4Q, 4),
+    'qrunetn': (QRUNetN, None),
+}
+
+
+def load_stacked(path):
+    """(N, H, W, C + 1) images with the mask as last channel, from a .pack or .npz file"""
+    if path.endswith('.pack'):
+        return PackedDataset(path)
+
+    d = np.load(path)
+    if 'data' in d:  # ISLE, already stacked
+        X = d['data']
+    else:
+        images = d['images']
+        if images.ndim == 3:
+            images = images[..., np.newaxis]
+        X = np.concatenate((images, d['masks'][..., np.newaxis]), axis=3)
+    return TensorDataset(torch.from_numpy(np.float32(X)))
+
+
+def calibrate(net, loader, device, quantiles, batch_fn=grayscale_batch, output_fn=net_output, threshold=0.5):
+    net.eval()
+    # heads of models without monotone=True can cross, those need the pairwise bins
+    accumulator = CalibrationAccumulator(quantiles, threshold, nested=getattr(net, 'monotone', False))
+
+    with torch.no_grad():
+        for batch in tqdm(loader, unit='batch'):
+            if isinstance(batch, (tuple, list)):
+                batch = batch[0]
+            images, masks = batch_fn(batch)
+            images = images.to(device=device, dtype=torch.float32, non_blocking=True)
+            masks = masks.to(device=device, dtype=torch.float32, non_blocking=True)
+
+            # foreground probability of every head, (B, Q, H, W)
+            probs = torch.stack([pred[:, 1] for pred in output_fn(net, images, masks)], dim=1)
+            accumulator.update(probs, masks)
+
+    return accumulator.finalize()
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Quantile calibration table of a QR U-Net')
+    parser.add_argument('--model', '-m', required=True, metavar='FILE', help='Model weights')
+    parser.add_argument('--arch', choices=list(architectures), default='qrunet_4q', help='Network')
+    parser.add_argument('--data', '-d', required=True, help='.pack or .npz test data')
+    parser.add_argument('--channels', type=int, default=1, help='Image channels (1 grayscale, 3 ISLE)')
+    parser.add_argument('--quantiles', type=float, nargs='+', default=None,
+                        help='Quantiles of the heads, high to low (default: bin centres)')
+    parser.add_argument('--n-quantiles', type=int, default=4, help='Heads of a qrunetn model')
+    parser.add_argument('--monotone', action='store_true', default=False,
+                        help='The qrunet_4q or qrunetn model was built with monotone=True')
+    parser.add_argument('--batch-size', '-b', type=int, default=64, help='Batch size')
+    parser.add_argument('--workers', type=int, default=2, help='DataLoader workers')
+    parser.add_argument('--output', '-o', default=None, help='Save the table as JSON')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    cls, n_quantiles = architectures[args.arch]
+    n_quantiles = n_quantiles or args.n_quantiles
+    quantiles = args.quantiles or default_quantiles(n_quantiles)
+    assert len(quantiles) == n_quantiles, f'{args.arch} has {n_quantiles} heads, got {len(quantiles)} quantiles'
+
+    if cls is QRUNetN:
+        net = QRUNetN(n_channels=args.channels, n_classes=2, n_quantiles=n_quantiles, quantiles=quantiles,
+                      monotone=args.monotone)
+        output_fn = stacked_output
+    elif cls is QRUNet_4Q:
+        net = QRUNet_4Q(n_channels=args.channels, n_classes=2, monotone=args.monotone)
+        output_fn = net_output
+    else:
+        assert not args.monotone, f'{args.arch} has no monotone heads'
+        net = cls(n_channels=args.channels, n_classes=2)
+        output_fn = net_output
+    batch_fn = grayscale_batch if args.channels == 1 else isle_batch
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    logging.info(f'Loading model {args.model}')
+    logging.info(f'Using device {device}')
+
+    net.to(device=device)
+    net.load_state_dict(torch.load(args.model, map_location=device))
+
+    logging.info('Model loaded!')
+
+    loader = DataLoader(load_stacked(args.data), batch_size=args.batch_size, shuffle=False,
+                        num_workers=args.workers, pin_memory=device.type == 'cuda')
+    rows = calibrate(net, loader, device, quantiles, batch_fn, output_fn)
+
+    print(f'{"bin":>3} {"range":>13} {"expected":>9} {"observed":>9} {"per image":>9} {"pixels":>10}')
+    for row in rows:
+        print(f'{row["bin"]:3d} [{row["lower"]:.3f},{row["upper"]:.3f}] {row["expected"]:9.3f} '
+              f'{row["observed"]:9.4f} {row["observed_per_image"]:9.4f} {row["pixels"]:10d}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'model': args.model, 'data': args.data, 'quantiles': quantiles, 'bins': rows}, f, indent=2)
@@ -1,140 +1,65 @@
 import argparse
 import logging
-import os
 
 import numpy as np
 import torch
-import torch.nn.functional as F
-from PIL import Image
-from torchvision import transforms
+from torch.utils.data import DataLoader, TensorDataset
 
-from utils.data_loading import BasicDataset
 from unet import QRUNet_4Q
-from utils.utils import plot_img_and_mask_QR
+from unet.unet_model import default_quantiles
+from util.calibration import CalibrationAccumulator
 from tqdm import tqdm
 
 
-def predict_img(net, full_img, device, scale_factor=1, out_threshold=0.5):
+def calibration_rates(net, loader, device, threshold=0.5):
+    """Average over images of the fraction of positive pixels in each of the five bins
+    between the quantile masks, the q1_p .. q5_p of this script, accumulated on device
+    """
     net.eval()
-    #img = torch.from_numpy(BasicDataset.preprocess(full_img, scale_factor, is_mask=False))
-    img = torch.tensor(full_img[np.newaxis, np.newaxis, :, :])  #.permute(
-    #(0, 3, 1, 2))  # .unsqueeze(0)
-    img = img.to(device=device, dtype=torch.float32)
+    accumulator = CalibrationAccumulator(default_quantiles(4), threshold, nested=net.monotone)
 
     with torch.no_grad():
-        pred_mask1, pred_mask2, pred_mask3,pred_mask4 = net(img)
+        for images, masks in tqdm(loader, unit='batch'):
+            images = images.to(device=device, dtype=torch.float32, non_blocking=True).unsqueeze(1)
+            masks = masks.to(device=device, dtype=torch.float32, non_blocking=True)
 
-        """         if net.n_classes > 1:
-            pred_mask1 = F.softmax(pred_mask1, dim=1)[0]
-            pred_mask2 = F.softmax(pred_mask2, dim=1)[0]
-            pred_mask3 = F.softmax(pred_mask3, dim=1)[0]
-        else:
-            pred_mask1 = torch.sigmoid(pred_mask1)[0]
-            pred_mask2 = torch.sigmoid(pred_mask2)[0]
-            pred_mask3 = torch.sigmoid(pred_mask3)[0]
-        """
-    return pred_mask1, pred_mask2, pred_mask3,pred_mask4
+            # foreground probability of every head, (B, 4, H, W)
+            probs = torch.stack([pred[:, 1] for pred in net(images)], dim=1)
+            accumulator.update(probs, masks)
 
+    return [row['observed_per_image'] for row in accumulator.finalize()]
 
 
-def get_output_filenames(args):
-    def _generate_name(fn):
-        split = os.path.splitext(fn)
-        return f'{split[0]}_OUT{split[1]}'
+def get_args():
+    parser = argparse.ArgumentParser(description='Quantile calibration of a QRUNet_4Q model on the LIDC test set')
+    parser.add_argument('--model', '-m', default='LIDC_AAJ_4Q.pth', metavar='FILE', help='Model weights')
+    parser.add_argument('--data', default='/big_disk/ajoshi/LIDC_data/test.npz', help='Test images and masks')
+    parser.add_argument('--batch-size', '-b', type=int, default=64, help='Batch size')
 
-    return args.output or list(map(_generate_name, args.input))
-
-
-def mask_to_image(mask: np.ndarray):
-    if mask.ndim == 2:
-        return Image.fromarray((mask * 255).astype(np.uint8))
-    elif mask.ndim == 3:
-        return Image.fromarray(
-            (np.argmax(mask, axis=0) * 255 / mask.shape[0]).astype(np.uint8))
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
-    d = np.load('/big_disk/ajoshi/LIDC_data/test.npz')
-    #    '/big_disk/akrami/git_repos_new/lesion-detector/VAE_9.5.2019/old results/data_24_ISEL_histeq.npz'
-    #)
-    model_file = 'LIDC_AAJ_4Q.pth' #'LIDC_QR_Anand75525.pth'
-
-    X = d['images']
-    M = d['masks']
-
-    X = np.stack((X, M), axis=3)
-
-    #X[:, :, :, 3] = np.float32(X[:, :, :, 3] > 0.5)
-
-    num_pix = X.shape[1] * X.shape[2]
+    d = np.load(args.data)
+    X = torch.from_numpy(np.float32(d['images']))
+    M = torch.from_numpy(np.float32(d['masks']))
 
     net = QRUNet_4Q(n_channels=1, n_classes=2)
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    logging.info(f'Loading model {model_file}')
+    logging.info(f'Loading model {args.model}')
     logging.info(f'Using device {device}')
 
     net.to(device=device)
-    net.load_state_dict(torch.load(model_file, map_location=device))
+    net.load_state_dict(torch.load(args.model, map_location=device))
 
     logging.info('Model loaded!')
-    q1_p = 0.0
-    q2_p = 0.0
-    q3_p = 0.0
-    q4_p = 0.0
-    q5_p = 0.0
-
-    nsub1 = 0
-    nsub2 = 0
-    nsub3 = 0
-    nsub4 = 0
-    nsub5 = 0
-
-    for i in tqdm(range(X.shape[0])):
-
-        img = np.float64(X[i, :, :, 0])
-        true_mask = np.float64(X[i, :, :, 1])
-
-        qmask1, qmask2, qmask3,qmask4 = predict_img(net=net,
-                                             full_img=img,
-                                             scale_factor=0.5,
-                                             out_threshold=0.5,
-                                             device=device)
-
-        qmask1 = qmask1[0, 1, ].cpu()
-        qmask2 = qmask2[0, 1, ].cpu()
-        qmask3 = qmask3[0, 1, ].cpu()
-        qmask4 = qmask4[0, 1, ].cpu()
-
-        #plot_img_and_mask_QR(img[:, :, 0], true_mask, qmask1, qmask2, qmask3)
-        q1msk = np.float64(qmask1 < 0.5)
-        #q2msk = np.float64(qmask1 > 0.5)
-        #q3msk = np.float64(qmask2 > 0.5)
-        #q4msk = np.float64(qmask3 > 0.5)
-
-        q2msk = np.float64(np.logical_and(qmask1 >= 0.5, qmask2 < 0.5))
-        q3msk = np.float64(np.logical_and(qmask2 >= 0.5, qmask3 < 0.5))
-        q4msk = np.float64(np.logical_and(qmask3 >= 0.5, qmask4 < 0.5))
-        q5msk = np.float64(qmask4 >= 0.5)
-
-        if np.sum(q1msk) > 0:
-            q1_p += np.sum(true_mask*q1msk) / (np.sum(q1msk))
-            nsub1 += 1
-        
-        if np.sum(q2msk) > 0:
-            q2_p += np.sum(true_mask*q2msk) / (np.sum(q2msk))
-            nsub2 += 1
-
-        if np.sum(q3msk) > 0:
-            q3_p += np.sum(true_mask*q3msk) / (np.sum(q3msk))
-            nsub3 += 1
-
-        if np.sum(q4msk) > 0:
-            q4_p += np.sum(true_mask*q4msk) / (np.sum(q4msk))
-            nsub4 += 1
-        if np.sum(q5msk) > 0:
-            q5_p += np.sum(true_mask*q5msk) / (np.sum(q5msk))
-            nsub5 += 1
-
-    print(q1_p/nsub1, q2_p/nsub2, q3_p/nsub3, q4_p/nsub4, q5_p/nsub5)
+
+    loader = DataLoader(TensorDataset(X, M), batch_size=args.batch_size, shuffle=False,
+                        pin_memory=device.type == 'cuda')
+    q1_p, q2_p, q3_p, q4_p, q5_p = calibration_rates(net, loader, device)
+
+    print(q1_p, q2_p, q3_p, q4_p, q5_p)
@@ -0,0 +1,57 @@
+""" Micro-benchmark of the QR validation scoring
+
+Times the per-batch scoring of the four QRUNet_4Q heads the old way (one_hot of the
+argmax for predictions and targets, keeping channel 1) against the channel_mask fast
+path in evaluate.py, which compares the two class logits directly. Checks that both
+give bitwise identical Dice and reports peak CUDA memory when run on a GPU.
+"""
+
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from evaluate import channel_mask, class_masks
+from util.dice_score import batch_dice
+from util.timing import time_call
+
+
+def score_one_hot(heads, mask_true):
+    target = F.one_hot(mask_true.long(), 2).permute(0, 3, 1, 2).float()[:, 1]
+    mask_pred = torch.stack([class_masks(pred)[:, 1] for pred in heads], dim=1)
+    return batch_dice(mask_pred, target.unsqueeze(1).expand_as(mask_pred)).per_class
+
+
+def score_fast(heads, mask_true):
+    target = (mask_true.long() == 1).float()
+    mask_pred = torch.stack([channel_mask(pred, 1) for pred in heads], dim=1)
+    return batch_dice(mask_pred, target.unsqueeze(1).expand_as(mask_pred)).per_class
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the QR validation Dice scoring')
+    parser.add_argument('--batch-size', '-b', type=int, default=40, help='Batch size')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256], help='Image sizes')
+    parser.add_argument('--heads', type=int, default=4, help='Quantile heads')
+    parser.add_argument('--repeats', type=int, default=50, help='Timed iterations')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print(f'device {device}, batch {args.batch_size}, heads {args.heads}')
+
+    for size in args.sizes:
+        heads = [torch.randn(args.batch_size, 2, size, size, device=device) for _ in range(args.heads)]
+        mask_true = (torch.rand(args.batch_size, size, size, device=device) > 0.7).float()
+        mask_true[0] = 0  # an empty target
+
+        reference = score_one_hot(heads, mask_true)
+        fast = score_fast(heads, mask_true)
+        assert torch.equal(reference, fast), f'{reference.tolist()} != {fast.tolist()}'
+
+        for name, score in (('one_hot', score_one_hot), ('fast', score_fast)):
+            ms, peak = time_call(lambda: score(heads, mask_true), args.repeats, device)
+            print(f'{size}x{size} {name:8s} {ms:8.3f} ms/batch {peak:8.1f} MiB peak')
@@ -0,0 +1,63 @@
+""" CPU latency of the eager QR U-Net against its exported TorchScript / ONNX graphs
+
+Runs batches of 128x128 slices (random, or the first images of an LIDC npz file)
+through the eager network, the BatchNorm-folded eager network and every exported
+artifact given, checks the outputs agree and prints the time per batch.
+
+    python bench_export.py -m LIDC_4Q_QR_all.pth --exported LIDC_4Q_QR_all.pt LIDC_4Q_QR_all.onnx
+"""
+
+import argparse
+
+import numpy as np
+import torch
+
+from export_qr import architectures, load_net
+from util.export import ExportedModel, fold_batchnorm
+from util.timing import time_call
+
+
+def as_tuple(output):
+    return tuple(output) if isinstance(output, (tuple, list)) else (output,)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark eager vs exported U-Net inference on CPU')
+    parser.add_argument('--model', '-m', required=True, metavar='FILE', help='Model weights')
+    parser.add_argument('--arch', choices=list(architectures), default='qrunet_4q', help='Network')
+    parser.add_argument('--exported', nargs='*', default=[], help='Exported .pt / .onnx files')
+    parser.add_argument('--data', default=None, help='npz file with 128x128 images (default: random)')
+    parser.add_argument('--batch-size', '-b', type=int, nargs='+', default=[1, 16], help='Batch sizes')
+    parser.add_argument('--threads', '-t', type=int, default=None, help='Intra-op threads')
+    parser.add_argument('--repeats', type=int, default=20, help='Timed iterations')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    net = load_net(args.arch, args.model)
+    models = {'eager': net, 'eager folded': fold_batchnorm(net)}
+    for path in args.exported:
+        models[path] = ExportedModel(path, threads=args.threads)
+
+    if args.data:
+        slices = torch.from_numpy(np.float32(np.load(args.data)['images'][:max(args.batch_size)]))
+    else:
+        slices = torch.rand(max(args.batch_size), 128, 128)
+    print(f'{torch.get_num_threads()} threads')
+
+    for batch_size in args.batch_size:
+        images = slices[:batch_size].unsqueeze(1)
+        with torch.no_grad():
+            reference = as_tuple(net(images))
+        for name, model in models.items():
+            output = as_tuple(model(images))
+            error = max(float((a - b).abs().max()) for a, b in zip(reference, output))
+            with torch.no_grad():
+                ms, _ = time_call(lambda: model(images), args.repeats)
+            print(f'batch {batch_size:3d} {name:32s} {ms:9.2f} ms/batch {ms / batch_size:8.2f} ms/slice '
+                  f'max abs diff {error:.2e}')
@@ -0,0 +1,67 @@
+""" Step time and peak memory of a ProbabilisticQRUnet training step
+
+Runs the train_LIDC_qr_prob_unet.py step (forward, elbo, l2 regularisation,
+backward, clipped Adam step) on random 128x128 slices with the prior and posterior
+encoders run separately and fused (fuse_encoders=True), starting from the same
+weights, and checks that both give the same latent spaces.
+"""
+
+import argparse
+import copy
+
+import torch
+
+from probabilistic_QRunet import ProbabilisticQRUnet
+from util.timing import time_call
+from utils import l2_regularisation
+
+
+def train_step(net, optimizer, images, true_masks):
+    net.forward(images, true_masks, training=True)
+    elbo = net.elbo(true_masks, epoch=10)
+    reg_loss = l2_regularisation(net.posterior) + l2_regularisation(net.prior) + l2_regularisation(net.fcomb.layers)
+    loss = -elbo + 1e-15 * reg_loss
+    optimizer.zero_grad()
+    loss.backward()
+    torch.nn.utils.clip_grad_norm_(net.parameters(), max_norm=1)
+    optimizer.step()
+
+
+def time_steps(net, images, true_masks, repeats, device):
+    optimizer = torch.optim.Adam(net.parameters(), lr=1e-3, weight_decay=0)
+    return time_call(lambda: train_step(net, optimizer, images, true_masks), repeats, device)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark fused prior/posterior encoders of ProbabilisticQRUnet')
+    parser.add_argument('--batch-size', '-b', type=int, default=24, help='Batch size')
+    parser.add_argument('--size', type=int, default=128, help='Image size')
+    parser.add_argument('--repeats', type=int, default=20, help='Timed steps')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    torch.manual_seed(11)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print(f'device {device}, batch {args.batch_size}, {args.size}x{args.size}')
+
+    net = ProbabilisticQRUnet(input_channels=1, num_classes=1, num_filters=[32,64,128,192], latent_dim=2,
+                              no_convs_fcomb=4, beta=10.0).to(device)
+    fused = copy.deepcopy(net)
+    fused.fuse_encoders = True
+
+    images = torch.rand(args.batch_size, 1, args.size, args.size, device=device)
+    true_masks = 0.9995 * (torch.rand(args.batch_size, 1, args.size, args.size, device=device) > 0.8).float() + 1e-4
+
+    with torch.no_grad():
+        net.forward(images, true_masks, training=True)
+        fused.forward(images, true_masks, training=True)
+        for name in ('prior_latent_space', 'posterior_latent_space'):
+            a, b = getattr(net, name).base_dist, getattr(fused, name).base_dist
+            assert torch.allclose(a.loc, b.loc, atol=1e-5) and torch.allclose(a.scale, b.scale, rtol=1e-4), name
+
+    for name, model in (('separate', net), ('fused', fused)):
+        ms, peak = time_steps(model, images, true_masks, args.repeats, device)
+        print(f'{name:9s} {ms:8.2f} ms/step {peak:8.1f} MiB peak')
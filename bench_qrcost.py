@@ -0,0 +1,59 @@
+""" Micro-benchmark of the QRcost_new implementations
+
+Times forward + backward of the original boolean-indexed QRcost_new against the
+elementwise one in util/qr_loss.py and its smoothed variant, on batches of
+128x128 and 256x256 maps, and checks the two exact versions agree.
+"""
+
+import argparse
+
+import torch
+
+from util.qr_loss import QRcost_new, QRcost_smooth
+from util.timing import time_call
+
+
+def QRcost_new_masked(f, Y, q=0.5):
+    error = f - Y
+    smaller_index = error < 0
+    bigger_index = 0 < error
+    loss = q * torch.sum(torch.abs(error)[smaller_index]) + (1-q) * torch.sum(torch.abs(error)[bigger_index])
+
+    return torch.sum(loss)
+
+
+def time_criterion(criterion, f, Y, q, repeats, device):
+    def step():
+        f.grad = None
+        criterion(f, Y, q=q).backward()
+
+    return time_call(step, repeats, device)[0]
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the QRcost_new implementations')
+    parser.add_argument('--batch-size', '-b', type=int, default=40, help='Batch size')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256], help='Image sizes')
+    parser.add_argument('--repeats', type=int, default=50, help='Timed iterations')
+    parser.add_argument('--q', type=float, default=0.875, help='Quantile')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print(f'device {device}, batch {args.batch_size}, q {args.q}')
+
+    for size in args.sizes:
+        f = torch.rand(args.batch_size, size, size, device=device, requires_grad=True)
+        Y = (torch.rand(args.batch_size, size, size, device=device) > 0.5).float()
+
+        masked = QRcost_new_masked(f, Y, q=args.q)
+        elementwise = QRcost_new(f, Y, q=args.q)
+        assert torch.allclose(masked, elementwise, rtol=1e-5), f'{masked.item()} != {elementwise.item()}'
+
+        for name, criterion in (('masked', QRcost_new_masked), ('elementwise', QRcost_new),
+                                ('smooth', QRcost_smooth)):
+            ms = time_criterion(criterion, f, Y, args.q, args.repeats, device)
+            print(f'{size}x{size} {name:12s} {ms:8.3f} ms/step')
@@ -2,273 +2,150 @@ import torch
 import torch.nn.functional as F
 from tqdm import tqdm
 
-from util.dice_score import multiclass_dice_coeff
+from util.dice_score import batch_dice
 import numpy as np
 
-def evaluate(net, dataloader, device):
-    net.eval()
-    num_val_batches = len(dataloader)
-    dice_score = 0
-
-    # iterate over the validation set
-    for batch in tqdm(dataloader, total=num_val_batches, desc='Validation round', unit='batch', leave=False):
-        image, mask_true = batch['image'], batch['mask']
-        # move images and labels to correct device and type
-        image = image.to(device=device, dtype=torch.float32)
-        mask_true = mask_true.to(device=device, dtype=torch.long)
-        mask_true = F.one_hot(mask_true, net.n_classes).permute(0, 3, 1, 2).float()
 
-        with torch.no_grad():
-            # predict the mask
-            mask_pred = net(image)
-            mask_pred = torch.float32(mask_pred>0.5)
+# Batch adapters, batch -> (image (B, C, H, W), mask (B, H, W))
 
-            # convert to one-hot format
-            if net.n_classes == 1:
-                mask_pred = (torch.sigmoid(mask_pred) > 0).float()
-            else:
-                mask_pred = F.one_hot(mask_pred.argmax(dim=1), net.n_classes).permute(0, 3, 1, 2).float()
+def dict_batch(batch):
+    return batch['image'], batch['mask']
 
-            # compute the Dice score, ignoring background
-            dice_score += multiclass_dice_coeff(mask_pred[:, :1, ...], mask_true[:, :1, ...], reduce_batch_first=False)
 
-    net.train()
-    return dice_score / num_val_batches
+def isle_batch(batch):
+    # stacked (B, H, W, 4) RGB image and mask
+    return batch[:,:,:,:3].permute((0,3,1,2)), batch[:,:,:,3]
 
 
+def grayscale_batch(batch):
+    # stacked (B, H, W, 2) image and mask
+    return batch[:,:,:,np.newaxis,0].permute((0,3,1,2)), batch[:,:,:,1]
 
-def evaluate_QR(net, dataloader, device):
-    net.eval()
-    num_val_batches = len(dataloader)
-    dice_score = 0
 
-    # iterate over the validation set
-    for batch in tqdm(dataloader, total=num_val_batches, desc='Validation round', unit='batch', leave=False):
-        image, mask_true = batch['image'], batch['mask']
-        # move images and labels to correct device and type
-        image = image.to(device=device, dtype=torch.float32)
-        mask_true = mask_true.to(device=device, dtype=torch.long)
-        mask_true = F.one_hot(mask_true, net.n_classes).permute(0, 3, 1, 2).float()
+def rater_batch(batch):
+    # stacked (B, H, W, 1 + R) image and rater masks, LIDCRaterDataset(mode='soft'); the
+    # image is repeated for each rater so every (slice, rater) pair is scored
+    image = batch[:,:,:,np.newaxis,0].permute((0,3,1,2))
+    masks = batch[:,:,:,1:].permute((0,3,1,2))
+    return image.repeat_interleave(masks.shape[1], dim=0), masks.flatten(0, 1)
 
-        with torch.no_grad():
-            # predict the mask
-            _, mask_pred, _ = net(image)
 
-            # convert to one-hot format
-            if net.n_classes == 1:
-                mask_pred = (torch.sigmoid(mask_pred) > 0).float()
-            else:
-                mask_pred = F.one_hot(mask_pred.argmax(dim=1), net.n_classes).permute(0, 3, 1, 2).float()
+def rater_mean_batch(batch):
+    # stacked (B, H, W, 1 + R) image and rater masks (or their mean), a pixel is foreground
+    # when at least half of the raters marked it (the mean itself would be truncated by .long())
+    image = batch[:,:,:,np.newaxis,0].permute((0,3,1,2))
+    return image, (batch[:,:,:,1:].mean(dim=3) >= 0.5).float()
 
-            # compute the Dice score, ignoring background
-            dice_score += multiclass_dice_coeff(mask_pred[:, :1, ...], mask_true[:, :1, ...], reduce_batch_first=False)
 
-    net.train()
-    return dice_score / num_val_batches
+# Output adapters, (net, image, mask) -> tuple of (B, C, H, W) predictions, one per head
 
+def net_output(net, image, mask):
+    # UNet gives a single prediction, QRUNet and QRUNet_4Q one per quantile
+    pred = net(image)
+    return tuple(pred) if isinstance(pred, (tuple, list)) else (pred,)
 
-def evaluate_isle(net, dataloader, device):
-    net.eval()
-    num_val_batches = len(dataloader)
-    dice_score = 0
 
-    # iterate over the validation set
-    for batch in tqdm(dataloader, total=num_val_batches, desc='Validation round', unit='batch', leave=False):
-        image, mask_true = batch[:,:,:,:3].permute((0,3,1,2)), batch[:,:,:,3]
-        # move images and labels to correct device and type
-        image = image.to(device=device, dtype=torch.float32)
-        mask_true = mask_true.to(device=device, dtype=torch.long)
-        mask_true = F.one_hot(mask_true, net.n_classes).permute(0, 3, 1, 2).float()
+def stacked_output(net, image, mask):
+    # QRUNetN, (B, Q, C, H, W)
+    return net(image).unbind(1)
 
-        with torch.no_grad():
-            # predict the mask
-            mask_pred = net(image)
 
-            # convert to one-hot format
-            if net.n_classes == 1:
-                mask_pred = (torch.sigmoid(mask_pred) > 0).float()
-            else:
-                mask_pred = F.one_hot(mask_pred.argmax(dim=1), net.n_classes).permute(0, 3, 1, 2).float()
+def prob_output(net, image, mask):
+    net.forward(image, mask.unsqueeze(1), training=True)
+    return (net.sample(testing=True),)
 
-            # compute the Dice score, ignoring background
-            dice_score += multiclass_dice_coeff(mask_pred[:, :1, ...], mask_true[:, :1, ...], reduce_batch_first=False)
 
-    net.train()
-    return dice_score / num_val_batches
+def prob_qr_output(net, image, mask):
+    net.forward(image, mask.unsqueeze(1), training=False)
+    return tuple(net.sample(testing=True))
 
-def evaluate_isle_QR(net, dataloader, device):
-    net.eval()
-    num_val_batches = len(dataloader)
-    dice_score = 0
 
-    # iterate over the validation set
-    for batch in tqdm(dataloader, total=num_val_batches, desc='Validation round', unit='batch', leave=False):
-        image, mask_true = batch[:,:,:,:3].permute((0,3,1,2)), batch[:,:,:,3]
-        # move images and labels to correct device and type
-        image = image.to(device=device, dtype=torch.float32)
-        mask_true = mask_true.to(device=device, dtype=torch.long)
-        mask_true = F.one_hot(mask_true, net.n_classes).permute(0, 3, 1, 2).float()
+def class_masks(pred, threshold=0.5):
+    # binary (B, C, H, W) masks of the predicted classes
+    if pred.shape[1] == 1:
+        return (torch.sigmoid(pred) > threshold).float()
+    return F.one_hot(pred.argmax(dim=1), pred.shape[1]).permute(0, 3, 1, 2).float()
 
-        with torch.no_grad():
-            # predict the mask
-            _, mask_pred, _ = net(image)
 
-            # convert to one-hot format
-            if net.n_classes == 1:
-                mask_pred = (torch.sigmoid(mask_pred) > 0).float()
-            else:
-                mask_pred = F.one_hot(mask_pred.argmax(dim=1), net.n_classes).permute(0, 3, 1, 2).float()
+def channel_mask(pred, channel, threshold=0.5):
+    # binary (B, H, W) mask of one predicted class, class_masks(pred)[:, channel] without
+    # materializing the other classes
+    if pred.shape[1] == 1:
+        return (torch.sigmoid(pred[:, channel]) > threshold).float()
+    if pred.shape[1] == 2:
+        # argmax of two logits only picks class 1 when it is strictly larger
+        foreground = pred[:, 1] > pred[:, 0]
+        return (foreground if channel == 1 else ~foreground).float()
+    return (pred.argmax(dim=1) == channel).float()
 
-            # compute the Dice score, ignoring background
-            dice_score += multiclass_dice_coeff(mask_pred[:, :1, ...], mask_true[:, :1, ...], reduce_batch_first=False)
 
-    net.train()
-    return dice_score / num_val_batches
+def evaluate_heads(net, dataloader, device, batch_fn=grayscale_batch, output_fn=net_output,
+                   channel=1, target_channel=1, threshold=0.5):
+    """Dice score of every head of net, averaged over the batches of dataloader
 
-def evaluate_grayscale(net, dataloader, device):
+    Each batch is split by batch_fn and predicted once by output_fn; the Dice of channel
+    of each head's prediction against the target pixels of class target_channel (the
+    mask itself if None) is accumulated on device. Single channel predictions are
+    thresholded at threshold after a sigmoid. Returns a (Q,) tensor.
+    """
     net.eval()
     num_val_batches = len(dataloader)
     dice_score = 0
 
     # iterate over the validation set
     for batch in tqdm(dataloader, total=num_val_batches, desc='Validation round', unit='batch', leave=False):
-        image, mask_true = batch[:,:,:,np.newaxis,0].permute((0,3,1,2)), batch[:,:,:,1]
+        image, mask_true = batch_fn(batch)
         # move images and labels to correct device and type
-        image = image.to(device=device, dtype=torch.float32)
-        mask_true = mask_true.to(device=device, dtype=torch.long)
-        mask_true = F.one_hot(mask_true, net.n_classes).permute(0, 3, 1, 2).float()
+        image = image.to(device=device, dtype=torch.float32, non_blocking=True)
+        mask_true = mask_true.to(device=device, dtype=torch.float32, non_blocking=True)
+        if target_channel is None:
+            target = mask_true
+        else:
+            target = (mask_true.long() == target_channel).float()
 
         with torch.no_grad():
-            # predict the mask
-            mask_pred = net(image)
+            heads = output_fn(net, image, mask_true)
 
-            # convert to one-hot format
-            if net.n_classes == 1:
-                mask_pred = (torch.sigmoid(mask_pred) > 0).float()
-            else:
-                mask_pred = F.one_hot(mask_pred.argmax(dim=1), net.n_classes).permute(0, 3, 1, 2).float()
-
-            # compute the Dice score, ignoring background
-            dice_score += multiclass_dice_coeff(mask_pred[:, :1, ...], mask_true[:, :1, ...], reduce_batch_first=False)
+            # predicted channel of every head, (B, Q, H, W)
+            mask_pred = torch.stack([channel_mask(pred, channel, threshold) for pred in heads], dim=1)
+            dice_score = dice_score + batch_dice(mask_pred, target.unsqueeze(1).expand_as(mask_pred)).per_class
 
     net.train()
     return dice_score / num_val_batches
 
 
+def evaluate(net, dataloader, device):
+    return evaluate_heads(net, dataloader, device, dict_batch, channel=0, target_channel=0, threshold=0)[0]
 
-def evaluate_grayscale_QR(net, dataloader, device):
-    net.eval()
-    num_val_batches = len(dataloader)
-    dice_score = 0
-
-    # iterate over the validation set
-    for batch in tqdm(dataloader, total=num_val_batches, desc='Validation round', unit='batch', leave=False):
-        image, mask_true = batch[:,:,:,np.newaxis,0].permute((0,3,1,2)), batch[:,:,:,1]
-        # move images and labels to correct device and type
-        image = image.to(device=device, dtype=torch.float32)
-        mask_true = mask_true.to(device=device, dtype=torch.long)
-        mask_true = F.one_hot(mask_true, net.n_classes).permute(0, 3, 1, 2).float()
 
-        with torch.no_grad():
-            # predict the mask
-            _, mask_pred, _ = net(image)
+def evaluate_QR(net, dataloader, device):
+    return evaluate_heads(net, dataloader, device, dict_batch, channel=0, target_channel=0, threshold=0)[1]
 
-            # convert to one-hot format
-            if net.n_classes == 1:
-                mask_pred = (torch.sigmoid(mask_pred) > 0.5).float()
-            else:
-                mask_pred = (F.one_hot(mask_pred.argmax(dim=1), net.n_classes).permute(0, 3, 1, 2)>0.5).float()
 
-            # compute the Dice score, ignoring background
-            dice_score += multiclass_dice_coeff(mask_pred[:, 1:2, ...], mask_true[:, 1:2, ...], reduce_batch_first=False)
+def evaluate_isle(net, dataloader, device):
+    return evaluate_heads(net, dataloader, device, isle_batch, channel=0, target_channel=0, threshold=0)[0]
 
-    net.train()
-    return dice_score / num_val_batches
 
-def evaluate_grayscale_QR_4Q(net, dataloader, device):
-    net.eval()
-    num_val_batches = len(dataloader)
-    dice_score = 0
+def evaluate_isle_QR(net, dataloader, device):
+    return evaluate_heads(net, dataloader, device, isle_batch, channel=0, target_channel=0, threshold=0)[1]
 
-    # iterate over the validation set
-    for batch in tqdm(dataloader, total=num_val_batches, desc='Validation round', unit='batch', leave=False):
-        image, mask_true = batch[:,:,:,np.newaxis,0].permute((0,3,1,2)), batch[:,:,:,1]
-        # move images and labels to correct device and type
-        image = image.to(device=device, dtype=torch.float32)
-        mask_true = mask_true.to(device=device, dtype=torch.long)
-        mask_true = F.one_hot(mask_true, net.n_classes).permute(0, 3, 1, 2).float()
 
-        with torch.no_grad():
-            # predict the mask
-            _,_, mask_pred, _ = net(image)
+def evaluate_grayscale(net, dataloader, device):
+    return evaluate_heads(net, dataloader, device, grayscale_batch, channel=0, target_channel=0, threshold=0)[0]
 
-            # convert to one-hot format
-            if net.n_classes == 1:
-                mask_pred = (torch.sigmoid(mask_pred) > 0.5).float()
-            else:
-                mask_pred = (F.one_hot(mask_pred.argmax(dim=1), net.n_classes).permute(0, 3, 1, 2)>0.5).float()
 
-            # compute the Dice score, ignoring background
-            dice_score += multiclass_dice_coeff(mask_pred[:, 1:2, ...], mask_true[:, 1:2, ...], reduce_batch_first=False)
+def evaluate_grayscale_QR(net, dataloader, device):
+    return evaluate_heads(net, dataloader, device, grayscale_batch)[1]
 
-    net.train()
-    return dice_score / num_val_batches
 
-def evaluate_grayscale_prob(net, dataloader, device):
-    net.eval()
-    num_val_batches = len(dataloader)
-    dice_score = 0
-
-    # iterate over the validation set
-    for batch in tqdm(dataloader, total=num_val_batches, desc='Validation round', unit='batch', leave=False):
-        image, true_masks = batch[:,:,:,np.newaxis,0].permute((0,3,1,2)), batch[:,:,:,1]
-        # move images and labels to correct device and type
-        image = image.to(device=device, dtype=torch.float32)
-        true_masks = true_masks.to(device=device, dtype=torch.float32)
-        true_masks = torch.unsqueeze(true_masks,1)
+def evaluate_grayscale_QR_4Q(net, dataloader, device):
+    return evaluate_heads(net, dataloader, device, grayscale_batch)[2]
 
-        with torch.no_grad():
-            # predict the mask
-            net.forward(image, true_masks, training=True)
-            mask_pred=net.sample(testing=True)
-            # convert to one-hot format
-            if net.n_classes == 1:
-                mask_pred = (torch.sigmoid(mask_pred) > 0.5).float()
-            else:
-                mask_pred = (F.one_hot(mask_pred.argmax(dim=1), net.n_classes+1).permute(0, 3, 1, 2)>0.5).float()
-
-            # compute the Dice score, ignoring background
-            dice_score += multiclass_dice_coeff(mask_pred[:, 0:1, ...], true_masks[:, 0:1, ...], reduce_batch_first=False)
 
-    net.train()
-    return dice_score / num_val_batches
+def evaluate_grayscale_prob(net, dataloader, device):
+    return evaluate_heads(net, dataloader, device, grayscale_batch, prob_output, channel=0, target_channel=None)[0]
 
 
 def evaluate_grayscale_QR_prob(net, dataloader, device):
-    net.eval()
-    num_val_batches = len(dataloader)
-    dice_score = 0
-
-    # iterate over the validation set
-    for batch in tqdm(dataloader, total=num_val_batches, desc='Validation round', unit='batch', leave=False):
-        image, true_masks = batch[:,:,:,np.newaxis,0].permute((0,3,1,2)), batch[:,:,:,1]
-        # move images and labels to correct device and type
-        image = image.to(device=device, dtype=torch.float32)
-        true_masks = true_masks.to(device=device, dtype=torch.float32)
-        true_masks = torch.unsqueeze(true_masks,1)
-
-        with torch.no_grad():
-            # predict the mask
-            net.forward(image, true_masks, training=False)
-            _, _, mask_pred, _ = net.sample(testing=True)
-            # convert to one-hot format
-            if net.n_classes == 1:
-                mask_pred = (torch.sigmoid(mask_pred) > 0.5).float()
-            else:
-                mask_pred = (F.one_hot(mask_pred.argmax(dim=1), net.n_classes+1).permute(0, 3, 1, 2)>0.5).float()
-
-            # compute the Dice score, ignoring background
-            dice_score += multiclass_dice_coeff(mask_pred[:, 0:1, ...], true_masks[:, 0:1, ...], reduce_batch_first=False)
-
-    net.train()
-    return dice_score / num_val_batches
+    return evaluate_heads(net, dataloader, device, grayscale_batch, prob_qr_output, channel=0,
+                          target_channel=None)[2]
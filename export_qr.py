@@ -0,0 +1,57 @@
+""" Export a trained UNet / QRUNet / QRUNet_4Q to TorchScript and ONNX for CPU inference
+
+    python export_qr.py -m LIDC_4Q_QR_all.pth --arch qrunet_4q -o LIDC_4Q_QR_all
+
+writes LIDC_4Q_QR_all.pt and LIDC_4Q_QR_all.onnx with BatchNorm folded into the
+convolutions; load them with util.export.ExportedModel.
+"""
+
+import argparse
+import logging
+
+import torch
+
+from unet import QRUNet, QRUNet_4Q, UNet
+from util.export import export_onnx, export_torchscript
+
+architectures = {
+    'unet': UNet,
+    'qrunet': QRUNet,
+    'qrunet_4q': QRUNet_4Q,
+}
+
+
+def load_net(arch, model_file, n_channels=1, n_classes=2):
+    net = architectures[arch](n_channels=n_channels, n_classes=n_classes)
+    net.load_state_dict(torch.load(model_file, map_location='cpu'))
+    return net.eval()
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Export a U-Net to TorchScript and ONNX')
+    parser.add_argument('--model', '-m', required=True, metavar='FILE', help='Model weights')
+    parser.add_argument('--arch', choices=list(architectures), default='qrunet_4q', help='Network')
+    parser.add_argument('--channels', type=int, default=1, help='Image channels')
+    parser.add_argument('--classes', type=int, default=2, help='Output classes')
+    parser.add_argument('--size', type=int, default=128, help='Input size the graphs are traced for')
+    parser.add_argument('--output', '-o', default=None, help='Output file name without extension')
+    parser.add_argument('--format', nargs='+', choices=['torchscript', 'onnx'], default=['torchscript', 'onnx'],
+                        help='Formats to write')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    net = load_net(args.arch, args.model, args.channels, args.classes)
+    example = torch.rand(1, args.channels, args.size, args.size)
+    output = args.output or args.model.rsplit('.', 1)[0]
+
+    if 'torchscript' in args.format:
+        export_torchscript(net, output + '.pt', example)
+        logging.info(f'TorchScript saved to {output}.pt')
+    if 'onnx' in args.format:
+        export_onnx(net, output + '.onnx', example)
+        logging.info(f'ONNX saved to {output}.onnx')
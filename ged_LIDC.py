@@ -0,0 +1,86 @@
+""" Generalized energy distance of QR and probabilistic U-Nets against the four LIDC raters
+
+    python ged_LIDC.py --model qr:LIDC_4Q_QR_all.pth prob_unet:LIDC_prob_20.pth prob_qr:LIDC_QR_prob_20.pth
+
+Reads the rater cache written by save_LIDC_data.py once and streams it in batches.
+The samples of an image are the four quantile masks of a QRUNet_4Q, n_samples prior
+samples of a ProbabilisticUnet, or n_samples x 4 quantile masks of a
+ProbabilisticQRUnet; see util/ged.py for the distances.
+"""
+
+import argparse
+import logging
+
+import torch
+from tqdm import tqdm
+
+from multi_rater_dice_LIDC import load_cache
+from probabilistic_QRunet import ProbabilisticQRUnet
+from probabilistic_unet import ProbabilisticUnet
+from unet import QRUNet_4Q
+from util.bitpack import unpack_masks_tensor
+from util.ged import GEDAccumulator
+
+
+def load_model(kind, path, device):
+    if kind == 'qr':
+        net = QRUNet_4Q(n_channels=1, n_classes=2)
+        net.to(device=device)
+        net.load_state_dict(torch.load(path, map_location=device))
+        return net.eval()
+
+    cls = ProbabilisticUnet if kind == 'prob_unet' else ProbabilisticQRUnet
+    net = cls.from_checkpoint(path, device, input_channels=1, num_classes=1, num_filters=[32, 64, 128, 192],
+                              latent_dim=2, no_convs_fcomb=4, beta=10.0)
+    return net.eval()
+
+
+def sample_masks(net, kind, images, n_samples, chunk_size=None):
+    """(B, S, H, W) bool sample masks of a batch of images"""
+    if kind == 'qr':
+        return torch.stack([pred[:, 1] for pred in net(images)], dim=1) > 0.5
+
+    net.forward(images, None, training=False)
+    logits = net.sample_n(n_samples, chunk_size)
+    return (torch.sigmoid(logits) > 0.5).flatten(1, -3)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Generalized energy distance of segmentation models on LIDC')
+    parser.add_argument('--model', '-m', nargs='+', required=True, metavar='KIND:FILE',
+                        help='Checkpoints, KIND is qr, prob_unet or prob_qr')
+    parser.add_argument('--data', default='/big_disk/ajoshi/LIDC_data/val_raters.pack',
+                        help='Cache written by save_LIDC_data.py')
+    parser.add_argument('--samples', '-s', type=int, default=16, help='Samples per image of the probabilistic models')
+    parser.add_argument('--chunk-size', type=int, default=None, help='(image, sample) pairs decoded at a time')
+    parser.add_argument('--batch-size', '-b', type=int, default=32, help='Batch size')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    logging.info(f'Using device {device}')
+
+    images, masks, width = load_cache(args.data)
+    models = []
+    for spec in args.model:
+        kind, path = spec.split(':', 1)
+        assert kind in ('qr', 'prob_unet', 'prob_qr'), f'Unknown model kind {kind}'
+        models.append((spec, kind, load_model(kind, path, device)))
+    accumulators = {spec: GEDAccumulator() for spec, _, _ in models}
+
+    with torch.no_grad():
+        for start in tqdm(range(0, len(images), args.batch_size), unit='batch'):
+            image = images[start:start + args.batch_size].to(device=device, dtype=torch.float32).unsqueeze(1)
+            raters = unpack_masks_tensor(masks[start:start + args.batch_size].to(device=device), width)
+            for spec, kind, net in models:
+                accumulators[spec].update(sample_masks(net, kind, image, args.samples, args.chunk_size), raters)
+
+    for spec, accumulator in accumulators.items():
+        print(spec)
+        for name, (mean, std) in accumulator.finalize().items():
+            print(f'  {name:13s} {mean:.4f} +- {std:.4f}')
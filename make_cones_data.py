@@ -3,6 +3,8 @@ from PIL import Image
 from tqdm import tqdm
 import random
 
+from util.bitpack import save_bitpacked
+
 num_samples_training = 30000
 num_samples_valid = 30000
 
@@ -56,6 +58,7 @@ for i in tqdm(range(num_samples_training)):
     data[i, ] = R  #= np.concatenate((data, R1))
     masks[i, ] = M  # = np.concatenate((masks, M))
 np.savez('cone_data_sim_training30000.npz', data=data, masks=masks)
+save_bitpacked('cone_data_sim_training30000.pack', data, masks)
 
 data = np.zeros((num_samples_valid, 256, 256), dtype=np.float16)
 masks = np.zeros((num_samples_valid, 256, 256), dtype=np.uint8)
@@ -82,3 +85,5 @@ for i in tqdm(range(num_samples_valid)):
     masks[i, ] = M  # = np.concatenate((masks, M))
     
 np.savez('cone_data_sim_valid30000.npz', data=data, masks=masks)
+save_bitpacked('cone_data_sim_valid30000.pack', data, masks)
+
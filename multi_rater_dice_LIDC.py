@@ -0,0 +1,157 @@
+""" Dice of several QRUNet_4Q checkpoints against the LIDC rater agreement masks
+
+Batched replacement of QR_dice_LIDC.py / both_dice_LIDC.py. The split is read once
+from the pre-decoded cache written by save_LIDC_data.py (images and the four bit-packed
+rater masks), every batch is moved to the device once and all models are run on it
+together as a ModelStack.
+For each quantile level k the reference is the set of pixels marked by more than
+(0.125, 0.375, 0.625, 0.875)[k] of the raters, a QR model is scored with its head k
+and a BCE model with its first head thresholded at the same level.
+
+    python multi_rater_dice_LIDC.py --model qr:LIDC_4Q_QR_all_init0.pth bce:LIDC_4Q_BCE_all_init0.pth
+"""
+
+import argparse
+import itertools
+import logging
+import os
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from unet import QRUNet_4Q
+from util.bitpack import unpack_masks_tensor
+from util.model_stack import ModelStack
+from util.packed import open_packed
+
+LEVELS = (0.125, 0.375, 0.625, 0.875)
+
+
+def dice_coef(mask1, mask2):
+    # per image and level Dice of (B, 4, H, W) masks, 0 when both are empty
+    mask1 = mask1.float()
+    mask2 = mask2.float()
+
+    return 2 * torch.sum(mask1 * mask2, dim=(2, 3)) / (torch.sum(mask1 + mask2, dim=(2, 3)) + 1e-8)
+
+
+def rater_masks(masks, levels):
+    """(B, R, H, W) rater masks to (B, 4, H, W) masks of the pixels marked by more than each level"""
+    m = masks.mean(dim=1, keepdim=True)
+    return m > levels.view(1, -1, 1, 1)
+
+
+def model_masks(heads, kind, levels):
+    """(B, 4, H, W) masks of a QRUNet_4Q output, one per level"""
+    if kind == 'qr':
+        return torch.stack([pred[:, 1] for pred in heads], dim=1) > 0.5
+    return heads[0][:, 1:2] > levels.view(1, -1, 1, 1)
+
+
+def load_cache(path):
+    arrays, meta = open_packed(path)
+    images = torch.from_numpy(np.array(arrays['images']))
+    masks = torch.from_numpy(np.array(arrays['masks']))
+    return images, masks, meta['mask_width']
+
+
+def load_models(specs, device):
+    models = []
+    for spec in specs:
+        kind, path = spec.split(':', 1)
+        assert kind in ('qr', 'bce'), f'Model kind must be qr or bce, got {kind}'
+        net = QRUNet_4Q(n_channels=1, n_classes=2)
+        net.to(device=device)
+        net.load_state_dict(torch.load(path, map_location=device))
+        net.eval()
+        models.append((os.path.splitext(os.path.basename(path))[0], kind, net))
+    return models
+
+
+def evaluate_models(models, images, masks, width, device, batch_size=64, vmap=True):
+    """Dice of every model against the raters and of every pair of models, per image and level
+
+    Returns the (N, 4) bool array of non-empty rater masks, per model the (N, 4) Dice
+    against them and the (N, 4) bool array of non-empty predictions, and per pair of
+    models the (N, 4) Dice between their masks.
+    """
+    levels = torch.tensor(LEVELS, device=device)
+    # all checkpoints in one call per batch
+    stack = ModelStack([net for _, _, net in models], vmap=vmap)
+    gt_nonempty, dice_gt, nonempty, dice_pair = [], {}, {}, {}
+
+    with torch.no_grad():
+        for start in tqdm(range(0, len(images), batch_size), unit='batch'):
+            image = images[start:start + batch_size].to(device=device, non_blocking=True)
+            image = image.to(dtype=torch.float32).unsqueeze(1)
+            gt = rater_masks(unpack_masks_tensor(masks[start:start + batch_size].to(device=device), width), levels)
+            gt_nonempty.append(gt.any(dim=3).any(dim=2))
+
+            output = stack(image)
+            preds = {name: model_masks(ModelStack.unstack(output, k), kind, levels)
+                     for k, (name, kind, _) in enumerate(models)}
+            for name, pred in preds.items():
+                dice_gt.setdefault(name, []).append(dice_coef(pred, gt))
+                nonempty.setdefault(name, []).append(pred.any(dim=3).any(dim=2))
+            for a, b in itertools.combinations(preds, 2):
+                dice_pair.setdefault((a, b), []).append(dice_coef(preds[a], preds[b]))
+
+    def cat(chunks):
+        return torch.cat(chunks).cpu().numpy()
+
+    return (cat(gt_nonempty), {k: cat(v) for k, v in dice_gt.items()}, {k: cat(v) for k, v in nonempty.items()},
+            {k: cat(v) for k, v in dice_pair.items()})
+
+
+def summarize(title, dice, keep, plot_file=None):
+    print(title)
+    scores = [dice[keep[:, k], k] for k in range(len(LEVELS))]
+    for level, s in zip(LEVELS, scores):
+        print(f'  m > {level}: {np.mean(s):.4f} +- {np.std(s):.4f} ({len(s)} slices)')
+
+    if plot_file:
+        import matplotlib.pyplot as plt
+
+        fig, ax1 = plt.subplots(nrows=1, ncols=1, sharey=True)
+        ax1.violinplot(scores, positions=range(len(LEVELS)))
+        ax1.set_xticks(range(len(LEVELS)))
+        fig.savefig(plot_file + '.pdf')
+        fig.savefig(plot_file + '.png')
+        plt.close(fig)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Dice of QR and BCE models against the LIDC rater agreement')
+    parser.add_argument('--model', '-m', nargs='+', required=True, metavar='KIND:FILE',
+                        help='Checkpoints to compare, KIND is qr or bce')
+    parser.add_argument('--data', default='/big_disk/ajoshi/LIDC_data/val_raters.pack',
+                        help='Cache written by save_LIDC_data.py')
+    parser.add_argument('--batch-size', '-b', type=int, default=64, help='Batch size')
+    parser.add_argument('--no-vmap', dest='vmap', action='store_false', default=True,
+                        help='Call the models one after the other instead of vmapping over stacked weights')
+    parser.add_argument('--plots', action='store_true', default=False, help='Save violin plots')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    logging.info(f'Using device {device}')
+
+    images, masks, width = load_cache(args.data)
+    if device.type == 'cuda':
+        images, masks = images.pin_memory(), masks.pin_memory()
+    models = load_models(args.model, device)
+
+    gt_nonempty, dice_gt, nonempty, dice_pair = evaluate_models(models, images, masks, width, device,
+                                                                batch_size=args.batch_size, vmap=args.vmap)
+
+    for name, dice in dice_gt.items():
+        summarize(f'{name} vs raters', dice, gt_nonempty, f'violinplot_{name}_vs_gt' if args.plots else None)
+    for (a, b), dice in dice_pair.items():
+        summarize(f'{a} vs {b}', dice, nonempty[a] | nonempty[b],
+                  f'violinplot_{a}_vs_{b}' if args.plots else None)
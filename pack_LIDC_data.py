@@ -0,0 +1,36 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+
+from util.packed import save_packed
+
+
+def pack_npz(npz_file, out_file, image_dtype=np.float16, mask_dtype=np.uint8):
+    d = np.load(npz_file)
+    images = d['images'].astype(image_dtype)
+    masks = d['masks'].astype(mask_dtype)
+
+    save_packed(out_file, meta={'source': os.path.basename(npz_file)}, images=images, masks=masks)
+    logging.info(f'{npz_file}: packed {len(images)} slices into {out_file}')
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Convert LIDC images/masks npz files to the memory-mapped packed format')
+    parser.add_argument('input', nargs='+', help='npz files with images and masks arrays')
+    parser.add_argument('--out-dir', '-o', default=None,
+                        help='Directory for the .pack files (defaults to next to each input)')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    for npz_file in args.input:
+        out_dir = args.out_dir or os.path.dirname(npz_file)
+        out_file = os.path.join(out_dir, os.path.splitext(os.path.basename(npz_file))[0] + '.pack')
+        pack_npz(npz_file, out_file)
@@ -0,0 +1,206 @@
+""" Batch inference of the QR models on directories, globs or npz files of 2D slices
+
+    python predict_qr.py -m LIDC_4Q_QR_all.pth -i /big_disk/ajoshi/LIDC_data/test/images/L*/ -o out/
+    python predict_qr.py -m LIDC_4Q_QR_all.pth -i /big_disk/ajoshi/LIDC_data/test.npz -o test_QR.npz
+
+Slices are decoded by DataLoader workers and predicted in batches. The quantile masks
+are written by a background thread, one PNG per slice and head (<name>_OUT_q<k>.png,
+head k as ordered by the model, highest quantile first), or as a single
+(N, Q, H, W) uint8 array when the input is an npz file. With -o the PNGs keep the
+directory layout of the inputs below their common parent, so slices with the same
+name from different subjects do not overwrite each other; without it they are
+written next to the inputs, and such outputs are never read back as inputs.
+"""
+
+import argparse
+import glob
+import logging
+import os
+import queue
+import re
+import threading
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
+
+from probabilistic_QRunet import ProbabilisticQRUnet
+from unet import QRUNet, QRUNet_4Q
+
+# masks written by MaskWriter, skipped when listing input slices
+OUTPUT_PATTERN = re.compile(r'_OUT_q\d+\.png$')
+
+
+class SliceDataset(Dataset):
+    """Grayscale slices from image files (scaled to [0, 1] like the LIDC PNGs) or an (N, H, W) array"""
+
+    def __init__(self, files=None, images=None, size=None):
+        assert (files is None) != (images is None), 'Give either files or images'
+        self.files = files
+        self.images = images
+        self.size = size
+
+    def __len__(self):
+        return len(self.files) if self.files is not None else len(self.images)
+
+    def __getitem__(self, idx):
+        if self.files is not None:
+            im = Image.open(self.files[idx]).convert('L')
+            if self.size:
+                im = im.resize((self.size, self.size))
+            image = np.float32(np.array(im)) / 255.0
+        else:
+            image = np.float32(self.images[idx])
+        return idx, torch.from_numpy(image).unsqueeze(0)
+
+
+def list_files(inputs):
+    files = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            files += sorted(glob.glob(os.path.join(pattern, '*.png')))
+        else:
+            files += sorted(glob.glob(pattern))
+    return [f for f in files if not OUTPUT_PATTERN.search(f)]
+
+
+def load_model(arch, model_file, device):
+    if arch == 'qrunet_4q':
+        net = QRUNet_4Q(n_channels=1, n_classes=2)
+    elif arch == 'qrunet':
+        net = QRUNet(n_channels=1, n_classes=2)
+    else:
+        net = ProbabilisticQRUnet(input_channels=1, num_classes=1, num_filters=[32, 64, 128, 192],
+                                  latent_dim=2, no_convs_fcomb=4, beta=10.0)
+    net.to(device=device)
+    net.load_state_dict(torch.load(model_file, map_location=device))
+    net.eval()
+    return net
+
+
+def predict_masks(net, arch, images, out_threshold=0.5):
+    """(B, 1, H, W) slices to (B, Q, H, W) uint8 quantile masks"""
+    with torch.no_grad():
+        if arch == 'prob_qr':
+            net.forward(images, None, training=False)
+            heads = [torch.sigmoid(pred[:, 0]) for pred in net.sample(testing=True)]
+        else:
+            heads = [pred[:, 1] for pred in net(images)]
+    return (torch.stack(heads, dim=1) > out_threshold).to(torch.uint8)
+
+
+class MaskWriter(threading.Thread):
+    """Writes predicted batches in the background so the device does not wait for PNG encoding
+
+    With files, batch masks are saved next to the inputs, or in out_dir under their
+    path relative to the common parent directory of all inputs; otherwise they are
+    collected into out_array.
+    """
+
+    def __init__(self, files=None, out_dir=None, out_array=None, max_batches=8):
+        super().__init__(daemon=True)
+        self.files = files
+        self.out_dir = out_dir
+        self.out_array = out_array
+        self.queue = queue.Queue(maxsize=max_batches)
+        self.error = None
+
+        if files and out_dir:
+            self.root = os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in files])
+            for directory in {os.path.dirname(self.output_name(f, 0)) for f in files}:
+                os.makedirs(directory, exist_ok=True)
+
+    def put(self, idx, masks):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((idx, masks))
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def output_name(self, filename, k):
+        stem = os.path.splitext(filename)[0]
+        if self.out_dir:
+            stem = os.path.join(self.out_dir, os.path.relpath(os.path.abspath(stem), self.root))
+        return f'{stem}_OUT_q{k}.png'
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                idx, masks = item
+                if self.out_array is not None:
+                    self.out_array[idx] = masks
+                    continue
+                for i, slice_masks in zip(idx, masks):
+                    for k, mask in enumerate(slice_masks):
+                        Image.fromarray(mask * 255).save(self.output_name(self.files[i], k))
+            except Exception as e:
+                self.error = e
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Predict quantile masks of many slices with a QR model')
+    parser.add_argument('--model', '-m', default='MODEL.pth', metavar='FILE', help='Model weights')
+    parser.add_argument('--arch', choices=['qrunet_4q', 'qrunet', 'prob_qr'], default='qrunet_4q',
+                        help='QRUNet_4Q, QRUNet or ProbabilisticQRUnet')
+    parser.add_argument('--input', '-i', nargs='+', required=True,
+                        help='Directories of PNG slices, globs, or a single npz file with images')
+    parser.add_argument('--output', '-o', default=None,
+                        help='Output directory, or npz file for npz input (default: next to the input)')
+    parser.add_argument('--size', type=int, default=128, help='Resize image files to size x size (0 keeps them)')
+    parser.add_argument('--batch-size', '-b', type=int, default=64, help='Batch size')
+    parser.add_argument('--workers', type=int, default=4, help='DataLoader workers')
+    parser.add_argument('--mask-threshold', '-t', type=float, default=0.5,
+                        help='Minimum probability value to consider a mask pixel white')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    logging.info(f'Loading model {args.model}')
+    logging.info(f'Using device {device}')
+    net = load_model(args.arch, args.model, device)
+    logging.info('Model loaded!')
+
+    npz_input = len(args.input) == 1 and args.input[0].endswith('.npz')
+    if npz_input:
+        images = np.load(args.input[0])['images']
+        dataset = SliceDataset(images=images)
+        n_heads = 4 if args.arch != 'qrunet' else 3
+        out_array = np.zeros((len(images), n_heads) + images.shape[1:], dtype=np.uint8)
+        writer = MaskWriter(out_array=out_array)
+    else:
+        files = list_files(args.input)
+        dataset = SliceDataset(files=files, size=args.size or None)
+        writer = MaskWriter(files=files, out_dir=args.output)
+    logging.info(f'Predicting {len(dataset)} slices')
+
+    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers,
+                        pin_memory=device.type == 'cuda')
+    writer.start()
+    try:
+        for idx, images in tqdm(loader, unit='batch'):
+            images = images.to(device=device, dtype=torch.float32, non_blocking=True)
+            masks = predict_masks(net, args.arch, images, args.mask_threshold)
+            writer.put(idx.numpy(), masks.cpu().numpy())
+    finally:
+        writer.close()
+
+    if npz_input:
+        out_file = args.output or os.path.splitext(args.input[0])[0] + '_QR.npz'
+        np.savez_compressed(out_file, masks=out_array)
+        logging.info(f'Masks saved to {out_file}')
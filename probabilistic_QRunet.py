@@ -1,10 +1,9 @@
 from unet_blocks import *
 from unet_prob import Unet
-from utils import init_weights,init_weights_orthogonal_normal, l2_regularisation
+from utils import init_weights,init_weights_orthogonal_normal, l2_regularisation, build_from_checkpoint
 import torch.nn.functional as F
 from torch.distributions import Normal, Independent, kl
-
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+from unet.unet_parts import cumulative_quantile_logits
 
 Q0 = 0.875 # 0.9 #0.75
 Q1 = 0.625 #0.8# 0.5
@@ -99,11 +98,6 @@ class AxisAlignedConvGaussian(nn.Module):
             self.name = 'Prior'
         self.encoder = Encoder(self.input_channels, self.num_filters, self.no_convs_per_block, initializers, posterior=self.posterior)
         self.conv_layer = nn.Conv2d(num_filters[-1], 2 * self.latent_dim, (1,1), stride=1)
-        self.show_img = 0
-        self.show_seg = 0
-        self.show_concat = 0
-        self.show_enc = 0
-        self.sum_input = 0
 
         nn.init.kaiming_normal_(self.conv_layer.weight, mode='fan_in', nonlinearity='relu')
         nn.init.normal_(self.conv_layer.bias)
@@ -112,14 +106,9 @@ class AxisAlignedConvGaussian(nn.Module):
 
         #If segmentation is not none, concatenate the mask to the channel axis of the input
         if segm is not None:
-            self.show_img = input
-            self.show_seg = segm
             input = torch.cat((input, segm), dim=1)
-            self.show_concat = input
-            self.sum_input = torch.sum(input)
 
         encoding = self.encoder(input)
-        self.show_enc = encoding
 
         #We only want the mean of the resulting hxw image
         encoding = torch.mean(encoding, dim=2, keepdim=True)
@@ -131,7 +120,12 @@ class AxisAlignedConvGaussian(nn.Module):
         #We squeeze the second dimension twice, since otherwise it won't work when batch size is equal to 1
         mu_log_sigma = torch.squeeze(mu_log_sigma, dim=2)
         mu_log_sigma = torch.squeeze(mu_log_sigma, dim=2)
+        return self.latent_space(mu_log_sigma)
 
+    def latent_space(self, mu_log_sigma):
+        """
+        The Gaussian for the batch_sizex(2*latent_dim) output of conv_layer
+        """
         mu = mu_log_sigma[:,:self.latent_dim]
         log_sigma = mu_log_sigma[:,self.latent_dim:]
 
@@ -140,12 +134,44 @@ class AxisAlignedConvGaussian(nn.Module):
         dist = Independent(Normal(loc=mu, scale=torch.exp(log_sigma)),1)
         return dist
 
+def fused_latent_spaces(prior, posterior, patch, segm):
+    """
+    The prior latent space of patch and the posterior latent space of patch and segm from one pass of grouped
+    convolutions, instead of running the two encoders one after the other over the same pixels.
+    The prior input is padded with a zero channel (with zero weights) to the shape of the posterior input,
+    the two inputs are concatenated along the channel axis and every convolution uses the weights of both
+    encoders with groups=2, so the parameters and state_dict of prior and posterior are unchanged.
+    """
+    def grouped_conv(layer_prior, layer_posterior, input):
+        weight_prior = layer_prior.weight
+        missing = layer_posterior.weight.shape[1] - weight_prior.shape[1]
+        if missing:
+            weight_prior = F.pad(weight_prior, (0, 0, 0, 0, 0, missing))
+        weight = torch.cat((weight_prior, layer_posterior.weight), dim=0)
+        bias = torch.cat((layer_prior.bias, layer_posterior.bias), dim=0)
+        return F.conv2d(input, weight, bias, stride=layer_prior.stride, padding=layer_prior.padding, groups=2)
+
+    input = torch.cat((patch, torch.zeros_like(segm), patch, segm), dim=1)
+    for layer_prior, layer_posterior in zip(prior.encoder.layers, posterior.encoder.layers):
+        if isinstance(layer_prior, nn.Conv2d):
+            input = grouped_conv(layer_prior, layer_posterior, input)
+        else:
+            input = layer_prior(input)
+
+    #We only want the mean of the resulting hxw image
+    encoding = torch.mean(input, dim=(2, 3), keepdim=True)
+    mu_log_sigma = grouped_conv(prior.conv_layer, posterior.conv_layer, encoding).flatten(1)
+    mu_log_sigma_prior, mu_log_sigma_posterior = mu_log_sigma.chunk(2, dim=1)
+    return prior.latent_space(mu_log_sigma_prior), posterior.latent_space(mu_log_sigma_posterior)
+
 class Fcomb(nn.Module):
     """
     A function composed of no_convs_fcomb times a 1x1 convolution that combines the sample taken from the latent space,
     and output of the UNet (the feature map) by concatenating them along their channel axis.
+    With monotone=True (num_classes=1) the four quantile logits come from one base logit plus
+    non-negative increments, so the masks of last_layer0..3 are nested by construction.
     """
-    def __init__(self, num_filters, latent_dim, num_output_channels, num_classes, no_convs_fcomb, initializers, use_tile=True):
+    def __init__(self, num_filters, latent_dim, num_output_channels, num_classes, no_convs_fcomb, initializers, use_tile=True, monotone=False):
         super(Fcomb, self).__init__()
         self.num_channels = num_output_channels #output channels
         self.num_classes = num_classes
@@ -155,6 +181,7 @@ class Fcomb(nn.Module):
         self.latent_dim = latent_dim
         self.use_tile = use_tile
         self.no_convs_fcomb = no_convs_fcomb 
+        self.monotone = monotone
         self.name = 'Fcomb'
 
         if self.use_tile:
@@ -170,55 +197,55 @@ class Fcomb(nn.Module):
 
             self.layers = nn.Sequential(*layers)
 
-            self.last_layer0 = nn.Conv2d(self.num_filters[0], self.num_classes, kernel_size=1)
-            self.last_layer1 = nn.Conv2d(self.num_filters[0], self.num_classes, kernel_size=1)
-            self.last_layer2 = nn.Conv2d(self.num_filters[0], self.num_classes, kernel_size=1)
-            self.last_layer3 = nn.Conv2d(self.num_filters[0], self.num_classes, kernel_size=1)
+            if self.monotone:
+                assert self.num_classes == 1, 'Monotone quantile heads need num_classes=1'
+                self.last_layer = nn.Conv2d(self.num_filters[0], 4, kernel_size=1)
+                self.last_layers = [self.last_layer]
+            else:
+                self.last_layer0 = nn.Conv2d(self.num_filters[0], self.num_classes, kernel_size=1)
+                self.last_layer1 = nn.Conv2d(self.num_filters[0], self.num_classes, kernel_size=1)
+                self.last_layer2 = nn.Conv2d(self.num_filters[0], self.num_classes, kernel_size=1)
+                self.last_layer3 = nn.Conv2d(self.num_filters[0], self.num_classes, kernel_size=1)
+                self.last_layers = [self.last_layer0, self.last_layer1, self.last_layer2, self.last_layer3]
 
 
             if initializers['w'] == 'orthogonal':
                 self.layers.apply(init_weights_orthogonal_normal)
-                self.last_layer0.apply(init_weights_orthogonal_normal)
-                self.last_layer1.apply(init_weights_orthogonal_normal)
-                self.last_layer2.apply(init_weights_orthogonal_normal)
-                self.last_layer3.apply(init_weights_orthogonal_normal)
+                for last_layer in self.last_layers:
+                    last_layer.apply(init_weights_orthogonal_normal)
 
             else:
                 self.layers.apply(init_weights)
-                self.last_layer0.apply(init_weights)
-                self.last_layer1.apply(init_weights)
-                self.last_layer2.apply(init_weights)
-                self.last_layer3.apply(init_weights)
-
-    def tile(self, a, dim, n_tile):
-        """
-        This function is taken form PyTorch forum and mimics the behavior of tf.tile.
-        Source: https://discuss.pytorch.org/t/how-to-tile-a-tensor/13853/3
-        """
-        init_dim = a.size(dim)
-        repeat_idx = [1] * a.dim()
-        repeat_idx[dim] = n_tile
-        a = a.repeat(*(repeat_idx))
-        order_index = torch.LongTensor(np.concatenate([init_dim * np.arange(n_tile) + i for i in range(init_dim)])).to(device)
-        return torch.index_select(a, dim, order_index)
+                for last_layer in self.last_layers:
+                    last_layer.apply(init_weights)
 
     def forward(self, feature_map, z):
         """
         Z is batch_sizexlatent_dim and feature_map is batch_sizexno_channelsxHxW.
-        So broadcast Z to batch_sizexlatent_dimxHxW. Behavior is exactly the same as tf.tile (verified)
+        The first 1x1 convolution sees the feature map concatenated with Z broadcast over HxW (as tf.tile would),
+        computed as a convolution of the feature map plus a per sample bias from Z, see latent_conv1x1.
         """
         if self.use_tile:
-            z = torch.unsqueeze(z,2)
-            z = self.tile(z, 2, feature_map.shape[self.spatial_axes[0]])
-            z = torch.unsqueeze(z,3)
-            z = self.tile(z, 3, feature_map.shape[self.spatial_axes[1]])
-
-            #Concatenate the feature map (output of the UNet) and the sample taken from the latent space
-            feature_map = torch.cat((feature_map, z), dim=self.channel_axis)
-            output = self.layers(feature_map)
+            output = latent_conv1x1(self.layers[0], feature_map, z)
+            output = self.layers[1:](output)
+            if self.monotone:
+                return cumulative_quantile_logits(self.last_layer(output)).split(1, dim=1)
             return self.last_layer0(output), self.last_layer1(output), self.last_layer2(output), self.last_layer3(output)
             #return 3.0*(self.last_layer_sigmoid(self.last_layer(output))-.5)
 
+    def quantile_logits(self, output):
+        """The four quantile heads stacked, n x 4 x num_classes x H x W"""
+        if self.monotone:
+            return cumulative_quantile_logits(self.last_layer(output)).unsqueeze(2)
+        return torch.stack([last_layer(output) for last_layer in self.last_layers], dim=1)
+
+    def forward_samples(self, feature_map, z, chunk_size=None):
+        """
+        Z is batch_sizexn_samplesxlatent_dim, returns batch_sizexn_samplesx4xnum_classesxHxW quantile logits
+        computed at most chunk_size samples at a time (see decode_latent_samples).
+        """
+        return decode_latent_samples(self.layers, self.quantile_logits, feature_map, z, chunk_size)
+
 
 class ProbabilisticQRUnet(nn.Module):
     """
@@ -228,9 +255,11 @@ class ProbabilisticQRUnet(nn.Module):
     num_filters: is a list consisint of the amount of filters layer
     latent_dim: dimension of the latent space
     no_cons_per_block: no convs per block in the (convolutional) encoder of prior and posterior
+    monotone: predict the four quantile maps as a base logit plus non-negative increments so they never cross
+    fuse_encoders: in training, run the prior and posterior encoders as one grouped pass (see fused_latent_spaces)
     """
 
-    def __init__(self, input_channels=1, num_classes=1, num_filters=[32,64,128,192], latent_dim=6, no_convs_fcomb=4, beta=10.0):
+    def __init__(self, input_channels=1, num_classes=1, num_filters=[32,64,128,192], latent_dim=6, no_convs_fcomb=4, beta=10.0, monotone=False, fuse_encoders=False):
         super(ProbabilisticQRUnet, self).__init__()
         self.input_channels = input_channels
         self.n_classes = num_classes
@@ -241,20 +270,31 @@ class ProbabilisticQRUnet(nn.Module):
         self.initializers = {'w':'he_normal', 'b':'normal'}
         self.beta = beta
         self.z_prior_sample = 0
+        self.fuse_encoders = fuse_encoders
 
-        self.unet = Unet(self.input_channels, self.n_classes , self.num_filters, self.initializers, apply_last_layer=False, padding=True).to(device)
-        self.prior = AxisAlignedConvGaussian(self.input_channels, self.num_filters, self.no_convs_per_block, self.latent_dim,  self.initializers,).to(device)
-        self.posterior = AxisAlignedConvGaussian(self.input_channels, self.num_filters, self.no_convs_per_block, self.latent_dim, self.initializers, posterior=True).to(device)
-        self.fcomb = Fcomb(self.num_filters, self.latent_dim, self.input_channels,   self.n_classes , self.no_convs_fcomb, {'w':'orthogonal', 'b':'normal'}, use_tile=True).to(device)
+        self.unet = Unet(self.input_channels, self.n_classes , self.num_filters, self.initializers, apply_last_layer=False, padding=True)
+        self.prior = AxisAlignedConvGaussian(self.input_channels, self.num_filters, self.no_convs_per_block, self.latent_dim,  self.initializers,)
+        self.posterior = AxisAlignedConvGaussian(self.input_channels, self.num_filters, self.no_convs_per_block, self.latent_dim, self.initializers, posterior=True)
+        self.fcomb = Fcomb(self.num_filters, self.latent_dim, self.input_channels,   self.n_classes , self.no_convs_fcomb, {'w':'orthogonal', 'b':'normal'}, use_tile=True, monotone=monotone)
+
+    @classmethod
+    def from_checkpoint(cls, path, device='cpu', **kwargs):
+        """
+        Build the network for the weights saved in path directly on device (see utils.build_from_checkpoint)
+        """
+        return build_from_checkpoint(cls, path, device, **kwargs)
 
     def forward(self, patch, segm, training=True):
         """
         Construct prior latent space for patch and run patch through UNet,
         in case training is True also construct posterior latent space
         """
-        if training:
-            self.posterior_latent_space = self.posterior.forward(patch, segm)
-        self.prior_latent_space = self.prior.forward(patch)
+        if training and self.fuse_encoders and segm.shape[1] == 1 and segm.shape[2:] == patch.shape[2:]:
+            self.prior_latent_space, self.posterior_latent_space = fused_latent_spaces(self.prior, self.posterior, patch, segm)
+        else:
+            if training:
+                self.posterior_latent_space = self.posterior.forward(patch, segm)
+            self.prior_latent_space = self.prior.forward(patch)
         self.unet_features = self.unet.forward(patch,False)
 
     def sample(self, testing=False):
@@ -272,6 +312,14 @@ class ProbabilisticQRUnet(nn.Module):
             self.z_prior_sample = z_prior
         return self.fcomb.forward(self.unet_features,z_prior)
 
+    def sample_n(self, n_samples, chunk_size=None):
+        """
+        Draw n_samples segmentations per image from the prior latent space of the last forward,
+        reusing its UNet features. Returns batch_sizexn_samplesx4xHxW quantile logits (num_classes=1).
+        """
+        z_prior = self.prior_latent_space.rsample((n_samples,)).transpose(0, 1)
+        return self.fcomb.forward_samples(self.unet_features, z_prior, chunk_size).squeeze(3)
+
 
     def reconstruct(self, use_posterior_mean=False, calculate_posterior=False, z_posterior=None):
         """
@@ -1,11 +1,9 @@
 from unet_blocks import *
 from unet_prob import Unet
-from utils import init_weights,init_weights_orthogonal_normal, l2_regularisation
+from utils import init_weights,init_weights_orthogonal_normal, l2_regularisation, build_from_checkpoint
 import torch.nn.functional as F
 from torch.distributions import Normal, Independent, kl
 
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
 Q0 = 0.875 # 0.9 #0.75
 Q1 = 0.625 #0.8# 0.5
 Q2 = 0.375 #0.75 #0.25
@@ -186,32 +184,15 @@ class Fcomb(nn.Module):
                 self.last_layer2.apply(init_weights)
                 self.last_layer3.apply(init_weights)
 
-    def tile(self, a, dim, n_tile):
-        """
-        This function is taken form PyTorch forum and mimics the behavior of tf.tile.
-        Source: https://discuss.pytorch.org/t/how-to-tile-a-tensor/13853/3
-        """
-        init_dim = a.size(dim)
-        repeat_idx = [1] * a.dim()
-        repeat_idx[dim] = n_tile
-        a = a.repeat(*(repeat_idx))
-        order_index = torch.LongTensor(np.concatenate([init_dim * np.arange(n_tile) + i for i in range(init_dim)])).to(device)
-        return torch.index_select(a, dim, order_index)
-
     def forward(self, feature_map, z):
         """
         Z is batch_sizexlatent_dim and feature_map is batch_sizexno_channelsxHxW.
-        So broadcast Z to batch_sizexlatent_dimxHxW. Behavior is exactly the same as tf.tile (verified)
+        The first 1x1 convolution sees the feature map concatenated with Z broadcast over HxW (as tf.tile would),
+        computed as a convolution of the feature map plus a per sample bias from Z, see latent_conv1x1.
         """
         if self.use_tile:
-            z = torch.unsqueeze(z,2)
-            z = self.tile(z, 2, feature_map.shape[self.spatial_axes[0]])
-            z = torch.unsqueeze(z,3)
-            z = self.tile(z, 3, feature_map.shape[self.spatial_axes[1]])
-
-            #Concatenate the feature map (output of the UNet) and the sample taken from the latent space
-            feature_map = torch.cat((feature_map, z), dim=self.channel_axis)
-            output = self.layers(feature_map)
+            output = latent_conv1x1(self.layers[0], feature_map, z)
+            output = self.layers[1:](output)
             return self.last_layer0(output), self.last_layer1(output), self.last_layer2(output), self.last_layer3(output)
             #return 3.0*(self.last_layer_sigmoid(self.last_layer(output))-.5)
 
@@ -238,10 +219,17 @@ class ProbabilisticQRUnet(nn.Module):
         self.beta = beta
         self.z_prior_sample = 0
 
-        self.unet = Unet(self.input_channels, self.n_classes , self.num_filters, self.initializers, apply_last_layer=False, padding=True).to(device)
-        self.prior = AxisAlignedConvGaussian(self.input_channels, self.num_filters, self.no_convs_per_block, self.latent_dim,  self.initializers,).to(device)
-        self.posterior = AxisAlignedConvGaussian(self.input_channels, self.num_filters, self.no_convs_per_block, self.latent_dim, self.initializers, posterior=True).to(device)
-        self.fcomb = Fcomb(self.num_filters, self.latent_dim, self.input_channels,   self.n_classes , self.no_convs_fcomb, {'w':'orthogonal', 'b':'normal'}, use_tile=True).to(device)
+        self.unet = Unet(self.input_channels, self.n_classes , self.num_filters, self.initializers, apply_last_layer=False, padding=True)
+        self.prior = AxisAlignedConvGaussian(self.input_channels, self.num_filters, self.no_convs_per_block, self.latent_dim,  self.initializers,)
+        self.posterior = AxisAlignedConvGaussian(self.input_channels, self.num_filters, self.no_convs_per_block, self.latent_dim, self.initializers, posterior=True)
+        self.fcomb = Fcomb(self.num_filters, self.latent_dim, self.input_channels,   self.n_classes , self.no_convs_fcomb, {'w':'orthogonal', 'b':'normal'}, use_tile=True)
+
+    @classmethod
+    def from_checkpoint(cls, path, device='cpu', **kwargs):
+        """
+        Build the network for the weights saved in path directly on device (see utils.build_from_checkpoint)
+        """
+        return build_from_checkpoint(cls, path, device, **kwargs)
 
     def forward(self, patch, segm, training=True):
         """
@@ -1,11 +1,9 @@
 from unet_blocks import *
 from unet_prob import Unet
-from utils import init_weights,init_weights_orthogonal_normal, l2_regularisation
+from utils import init_weights,init_weights_orthogonal_normal, l2_regularisation, build_from_checkpoint
 import torch.nn.functional as F
 from torch.distributions import Normal, Independent, kl
 
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
 
 def BCELosstmp(input, target):
     L = target*torch.log2(input) + (1.0-target)*torch.log2(1.0-input)
@@ -171,35 +169,25 @@ class Fcomb(nn.Module):
                 self.layers.apply(init_weights)
                 self.last_layer.apply(init_weights)
 
-    def tile(self, a, dim, n_tile):
-        """
-        This function is taken form PyTorch forum and mimics the behavior of tf.tile.
-        Source: https://discuss.pytorch.org/t/how-to-tile-a-tensor/13853/3
-        """
-        init_dim = a.size(dim)
-        repeat_idx = [1] * a.dim()
-        repeat_idx[dim] = n_tile
-        a = a.repeat(*(repeat_idx))
-        order_index = torch.LongTensor(np.concatenate([init_dim * np.arange(n_tile) + i for i in range(init_dim)])).to(device)
-        return torch.index_select(a, dim, order_index)
-
     def forward(self, feature_map, z):
         """
         Z is batch_sizexlatent_dim and feature_map is batch_sizexno_channelsxHxW.
-        So broadcast Z to batch_sizexlatent_dimxHxW. Behavior is exactly the same as tf.tile (verified)
+        The first 1x1 convolution sees the feature map concatenated with Z broadcast over HxW (as tf.tile would),
+        computed as a convolution of the feature map plus a per sample bias from Z, see latent_conv1x1.
         """
         if self.use_tile:
-            z = torch.unsqueeze(z,2)
-            z = self.tile(z, 2, feature_map.shape[self.spatial_axes[0]])
-            z = torch.unsqueeze(z,3)
-            z = self.tile(z, 3, feature_map.shape[self.spatial_axes[1]])
-
-            #Concatenate the feature map (output of the UNet) and the sample taken from the latent space
-            feature_map = torch.cat((feature_map, z), dim=self.channel_axis)
-            output = self.layers(feature_map)
+            output = latent_conv1x1(self.layers[0], feature_map, z)
+            output = self.layers[1:](output)
             return self.last_layer(output)
             #return 3.0*(self.last_layer_sigmoid(self.last_layer(output))-.5)
 
+    def forward_samples(self, feature_map, z, chunk_size=None):
+        """
+        Z is batch_sizexn_samplesxlatent_dim, returns batch_sizexn_samplesxnum_classesxHxW logits
+        computed at most chunk_size samples at a time (see decode_latent_samples).
+        """
+        return decode_latent_samples(self.layers, self.last_layer, feature_map, z, chunk_size)
+
 
 class ProbabilisticUnet(nn.Module):
     """
@@ -223,10 +211,17 @@ class ProbabilisticUnet(nn.Module):
         self.beta = beta
         self.z_prior_sample = 0
 
-        self.unet = Unet(self.input_channels, self.n_classes , self.num_filters, self.initializers, apply_last_layer=False, padding=True).to(device)
-        self.prior = AxisAlignedConvGaussian(self.input_channels, self.num_filters, self.no_convs_per_block, self.latent_dim,  self.initializers,).to(device)
-        self.posterior = AxisAlignedConvGaussian(self.input_channels, self.num_filters, self.no_convs_per_block, self.latent_dim, self.initializers, posterior=True).to(device)
-        self.fcomb = Fcomb(self.num_filters, self.latent_dim, self.input_channels,   self.n_classes , self.no_convs_fcomb, {'w':'orthogonal', 'b':'normal'}, use_tile=True).to(device)
+        self.unet = Unet(self.input_channels, self.n_classes , self.num_filters, self.initializers, apply_last_layer=False, padding=True)
+        self.prior = AxisAlignedConvGaussian(self.input_channels, self.num_filters, self.no_convs_per_block, self.latent_dim,  self.initializers,)
+        self.posterior = AxisAlignedConvGaussian(self.input_channels, self.num_filters, self.no_convs_per_block, self.latent_dim, self.initializers, posterior=True)
+        self.fcomb = Fcomb(self.num_filters, self.latent_dim, self.input_channels,   self.n_classes , self.no_convs_fcomb, {'w':'orthogonal', 'b':'normal'}, use_tile=True)
+
+    @classmethod
+    def from_checkpoint(cls, path, device='cpu', **kwargs):
+        """
+        Build the network for the weights saved in path directly on device (see utils.build_from_checkpoint)
+        """
+        return build_from_checkpoint(cls, path, device, **kwargs)
 
     def forward(self, patch, segm, training=True):
         """
@@ -253,6 +248,14 @@ class ProbabilisticUnet(nn.Module):
             self.z_prior_sample = z_prior
         return self.fcomb.forward(self.unet_features,z_prior)
 
+    def sample_n(self, n_samples, chunk_size=None):
+        """
+        Draw n_samples segmentations per image from the prior latent space of the last forward,
+        reusing its UNet features. Returns batch_sizexn_samplesxnum_classesxHxW logits.
+        """
+        z_prior = self.prior_latent_space.rsample((n_samples,)).transpose(0, 1)
+        return self.fcomb.forward_samples(self.unet_features, z_prior, chunk_size)
+
 
     def reconstruct(self, use_posterior_mean=False, calculate_posterior=False, z_posterior=None):
         """
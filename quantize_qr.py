@@ -0,0 +1,134 @@
+""" Post-training static int8 quantization of a QRUNet_4Q (or QRUNet) for CPU inference
+
+    python quantize_qr.py -m LIDC_4Q_QR_all.pth --data /big_disk/ajoshi/LIDC_data/train_less_sub_1000.pack \
+        --eval-data /big_disk/ajoshi/LIDC_data/test.npz -o LIDC_4Q_QR_all_int8.pt
+    python quantize_qr.py -m ISLE_QR64.pth --arch qrunet --channels 3 --quantiles 0.85 0.5 0.15 \
+        --data /big_disk/ajoshi/ISLES2015/ISEL_28sub_slices_0_182_histeq_nonzeroslices_training64.npz
+
+Grayscale (LIDC) slices are split with evaluate.grayscale_batch, 3-channel (ISLE)
+slices with evaluate.isle_batch. The network is traced with torch.fx; prepare_fx
+fuses the Conv-BN-ReLU stacks of the DoubleConv blocks and inserts observers, a few
+hundred slices calibrate them, and convert_fx produces the int8 model, saved as TorchScript (load it with
+util.export.ExportedModel). The float32 and int8 models are then compared on the
+evaluation slices: Dice of every head (evaluate.evaluate_heads), the quantile
+calibration table (QR_calibration.calibrate) and the CPU time per batch.
+"""
+
+import argparse
+import copy
+import logging
+
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+
+from QR_calibration import architectures, calibrate, load_stacked
+from evaluate import evaluate_heads, grayscale_batch, isle_batch
+from unet.unet_model import default_quantiles
+from util.timing import time_call
+
+
+def stacked(batch_fn):
+    """batch_fn for the batches of load_stacked datasets"""
+    def split(batch):
+        # PackedDataset gives the stacked tensor, TensorDataset a one element list
+        return batch_fn(batch[0] if isinstance(batch, (tuple, list)) else batch)
+    return split
+
+
+def quantize(net, loader, example, batch_fn, backend='x86'):
+    """int8 copy of the float net, with observers calibrated on the batches of loader"""
+    torch.backends.quantized.engine = backend
+    prepared = prepare_fx(copy.deepcopy(net).eval(), get_default_qconfig_mapping(backend), example_inputs=(example,))
+
+    with torch.no_grad():
+        for batch in tqdm(loader, desc='Calibration', unit='batch'):
+            images, _ = batch_fn(batch)
+            prepared(images.to(dtype=torch.float32))
+
+    return convert_fx(prepared)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Post-training int8 quantization of a QR U-Net')
+    parser.add_argument('--model', '-m', required=True, metavar='FILE', help='Float model weights')
+    parser.add_argument('--arch', choices=['qrunet_4q', 'qrunet'], default='qrunet_4q', help='Network')
+    parser.add_argument('--channels', type=int, choices=[1, 3], default=1,
+                        help='Image channels (1 grayscale LIDC, 3 ISLE)')
+    parser.add_argument('--quantiles', type=float, nargs='+', default=None,
+                        help='Quantiles of the heads, high to low (default: bin centres)')
+    parser.add_argument('--data', '-d', required=True, help='.pack or .npz slices for calibration')
+    parser.add_argument('--eval-data', default=None,
+                        help='.pack or .npz slices for evaluation (default: the slices after the calibration ones)')
+    parser.add_argument('--calibration-slices', type=int, default=300, help='Slices used to calibrate')
+    parser.add_argument('--eval-slices', type=int, default=1000, help='Slices used to compare the models')
+    parser.add_argument('--batch-size', '-b', type=int, default=32, help='Batch size')
+    parser.add_argument('--backend', choices=['x86', 'fbgemm', 'qnnpack'], default='x86',
+                        help='Quantized kernels (qnnpack on ARM)')
+    parser.add_argument('--threads', '-t', type=int, default=None, help='Intra-op threads')
+    parser.add_argument('--output', '-o', default=None, help='TorchScript file of the int8 model')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device('cpu')
+
+    cls, n_quantiles = architectures[args.arch]
+    quantiles = args.quantiles or default_quantiles(n_quantiles)
+    assert len(quantiles) == n_quantiles, f'{args.arch} has {n_quantiles} heads, got {len(quantiles)} quantiles'
+    batch_fn = stacked(grayscale_batch if args.channels == 1 else isle_batch)
+
+    net = cls(n_channels=args.channels, n_classes=2)
+    net.load_state_dict(torch.load(args.model, map_location=device))
+    net.eval()
+
+    calib_set = load_stacked(args.data)
+    n_calib = min(args.calibration_slices, len(calib_set))
+    if args.eval_data:
+        eval_set = load_stacked(args.eval_data)
+        eval_idx = range(min(args.eval_slices, len(eval_set)))
+    else:
+        eval_set = calib_set
+        eval_idx = range(n_calib, min(n_calib + args.eval_slices, len(eval_set)))
+    calib_loader = DataLoader(Subset(calib_set, range(n_calib)), batch_size=args.batch_size, shuffle=False)
+    eval_loader = DataLoader(Subset(eval_set, eval_idx), batch_size=args.batch_size, shuffle=False)
+
+    example, _ = batch_fn(next(iter(calib_loader)))
+    example = example[:1].to(dtype=torch.float32)
+    qnet = quantize(net, calib_loader, example, batch_fn, args.backend)
+
+    if args.output:
+        with torch.no_grad():
+            torch.jit.save(torch.jit.trace(qnet, example), args.output)
+        logging.info(f'int8 model saved to {args.output}')
+
+    results = {}
+    for name, model in (('float32', net), ('int8', qnet)):
+        results[name] = {
+            'dice': evaluate_heads(model, eval_loader, device, batch_fn=batch_fn).tolist(),
+            'calibration': calibrate(model, eval_loader, device, quantiles, batch_fn=batch_fn),
+        }
+    images, _ = batch_fn(next(iter(eval_loader)))
+    images = images.to(dtype=torch.float32)
+
+    print('head  quantile  Dice float32  Dice int8')
+    for k, q in enumerate(quantiles):
+        print(f'{k:4d}  {q:8.3f}  {results["float32"]["dice"][k]:12.4f}  {results["int8"]["dice"][k]:9.4f}')
+
+    print('bin  expected  observed float32  observed int8  drift')
+    for row32, row8 in zip(results['float32']['calibration'], results['int8']['calibration']):
+        print(f'{row32["bin"]:3d}  {row32["expected"]:8.3f}  {row32["observed"]:16.4f}  {row8["observed"]:13.4f}'
+              f'  {row8["observed"] - row32["observed"]:+.4f}')
+
+    with torch.no_grad():
+        ms32, _ = time_call(lambda: net(images), repeats=10, warmup=1)
+        ms8, _ = time_call(lambda: qnet(images), repeats=10, warmup=1)
+    print(f'{torch.get_num_threads()} threads, batch {images.shape[0]}: float32 {ms32:.1f} ms, int8 {ms8:.1f} ms '
+          f'({ms32 / ms8:.2f}x)')
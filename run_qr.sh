@@ -1,13 +1,3 @@
-python train_qr_LIDC_4Q_250.py
-python train_qr_LIDC_4Q_500.py
-python train_qr_LIDC_4Q_1000.py
-python train_qr_LIDC_4Q_2500.py
-python train_qr_LIDC_4Q_5000.py
-python train_qr_LIDC_4Q_all.py
-python train_qr_BCE_4Q_250.py
-python train_qr_BCE_4Q_500.py
-python train_qr_BCE_4Q_1000.py
-python train_qr_BCE_4Q_2500.py
-python train_qr_BCE_4Q_5000.py
-python train_qr_BCE_4Q_all.py
-
+python train_qr_sweep.py --config configs/lidc_4q_sweep.json
+# on a many-core CPU node, run the sweep as concurrent jobs (resumes unfinished ones):
+# python schedule_sweep.py configs/lidc_4q_sweep.json --jobs 8 --device cpu
@@ -1,52 +1,107 @@
+import argparse
 import glob
+import logging
 import os
-from PIL import Image
+from multiprocessing import Pool
+
 import numpy as np
+from PIL import Image
 from tqdm import tqdm
 
-mode = 'train'
+from util.bitpack import pack_masks, packed_width
+from util.packed import create_packed, open_packed, read_header
 
-subids = glob.glob('/big_disk/ajoshi/LIDC_data/'+mode+'/images/L*/*.png')
+N_RATERS = 4
 
-subids = subids[:5000]
 
-images = np.zeros((4*len(subids),128,128))
-masks = np.zeros((4*len(subids),128,128))
+def mask_files(root, mode, img_file):
+    img_pth, img_base = os.path.split(img_file)
+    _, sub_name = os.path.split(img_pth)
+    return [os.path.join(root, mode, 'gt', sub_name, img_base[:-4] + f'_l{r}.png') for r in range(N_RATERS)]
 
-#subids = 
 
-for i, img_file in enumerate(tqdm(subids)):
+def decode_slice(job):
+    i, img_file, msk_files, size = job
 
-    img_pth, img_base = os.path.split(img_file)
+    im = Image.open(img_file).resize((size, size))
+    image = np.float16(np.float32(np.array(im)) / 255.0)
 
-    _, sub_name = os.path.split(img_pth)
+    masks = np.zeros((N_RATERS, size, size), dtype=np.uint8)
+    for r, msk_file in enumerate(msk_files):
+        m = Image.open(msk_file).resize((size, size), Image.NEAREST)
+        masks[r] = np.array(m) > 128
+
+    return i, image, pack_masks(masks)
+
+
+def open_output(out_file, subids, size):
+    """Open a partially written output for resuming, or preallocate a new one"""
+    new_meta = {'ids': subids, 'size': size, 'raters': N_RATERS, 'mask_width': size}
+    if os.path.exists(out_file):
+        try:
+            meta = read_header(out_file)['meta']
+        except ValueError:
+            meta = None
+        if meta == new_meta:
+            arrays, _ = open_packed(out_file, mode='r+')
+            logging.info(f'Resuming {out_file}: {int(arrays["done"].sum())}/{len(subids)} slices already converted')
+            return arrays
+        logging.info(f'{out_file} was written for a different slice list, starting over')
+
+    n = len(subids)
+    return create_packed(out_file, {'images': ((n, size, size), np.float16),
+                                    'masks': ((n, N_RATERS, size, packed_width(size)), np.uint8),
+                                    'done': ((n,), np.uint8)},
+                         meta=new_meta)
+
+
+def convert(root, mode, out_file, limit=None, size=128, workers=None, flush_every=512):
+    subids = sorted(glob.glob(os.path.join(root, mode, 'images', 'L*', '*.png')))
+    if limit:
+        subids = subids[:limit]
+    if not subids:
+        raise RuntimeError(f'No LIDC slices found under {os.path.join(root, mode, "images")}')
+
+    out = open_output(out_file, [os.path.relpath(f, root) for f in subids], size)
+    todo = [(i, f, mask_files(root, mode, f), size) for i, f in enumerate(subids) if not out['done'][i]]
+
+    with Pool(workers) as pool:
+        for n, (i, image, masks) in enumerate(tqdm(pool.imap_unordered(decode_slice, todo, chunksize=16),
+                                                   total=len(todo), unit='slice')):
+            out['images'][i] = image
+            out['masks'][i] = masks
+            out['done'][i] = 1
+
+            # flush periodically so a crash only loses the slices decoded since the last flush
+            if (n + 1) % flush_every == 0:
+                out['images'].flush()
+                out['masks'].flush()
+                out['done'].flush()
+
+    for a in out.values():
+        a.flush()
+    logging.info(f'Wrote {len(subids)} {mode} slices to {out_file}')
 
-    msk0_file = '/big_disk/ajoshi/LIDC_data/'+mode+'/gt/' + sub_name +'/' + img_base[:-4] + '_l0.png'
-    msk1_file = '/big_disk/ajoshi/LIDC_data/'+mode+'/gt/' + sub_name +'/' + img_base[:-4] + '_l1.png'
-    msk2_file = '/big_disk/ajoshi/LIDC_data/'+mode+'/gt/' + sub_name +'/' + img_base[:-4] + '_l2.png'
-    msk3_file = '/big_disk/ajoshi/LIDC_data/'+mode+'/gt/' + sub_name +'/' + img_base[:-4] + '_l3.png'
 
-    im = Image.open(img_file)
-    im = im.resize((128,128))
-    m0 = Image.open(msk0_file)
-    m0 = m0.resize((128,128),Image.NEAREST)
-    m1 = Image.open(msk1_file)
-    m1 = m1.resize((128,128),Image.NEAREST)
-    m2 = Image.open(msk2_file)
-    m2 = m2.resize((128,128),Image.NEAREST)
-    m3 = Image.open(msk3_file)
-    m3 = m0.resize((128,128),Image.NEAREST)
+def get_args():
+    parser = argparse.ArgumentParser(description='Decode the LIDC PNG slices and rater masks into a packed array file')
+    parser.add_argument('--root', default='/big_disk/ajoshi/LIDC_data', help='LIDC data directory')
+    parser.add_argument('--mode', default='train', help='Split to convert (train, val or test)')
+    parser.add_argument('--out', '-o', default=None, help='Output .pack file')
+    parser.add_argument('--limit', type=int, default=None, help='Only convert the first N slices')
+    parser.add_argument('--size', type=int, default=128, help='Resize slices to size x size')
+    parser.add_argument('--workers', '-j', type=int, default=None, help='Decoder processes (default: all cores)')
 
+    return parser.parse_args()
 
 
-    images[4*i,:,:] = np.float32(np.array(im))/255.0
-    images[4*i+1,:,:] = np.float32(np.array(im))/255.0
-    images[4*i+2,:,:] = np.float32(np.array(im))/255.0
-    images[4*i+3,:,:] = np.float32(np.array(im))/255.0
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
-    masks[4*i,:,:] = np.array(m0) > 128
-    masks[4*i+1,:,:] = np.array(m1) > 128
-    masks[4*i+2,:,:] = np.array(m2) > 128
-    masks[4*i+3,:,:] = np.array(m3) > 128
+    out_file = args.out
+    if out_file is None:
+        suffix = f'_less_sub_{args.limit}' if args.limit else ''
+        out_file = os.path.join(args.root, f'{args.mode}{suffix}_raters.pack')
 
-np.savez('/big_disk/ajoshi/LIDC_data/' + mode + '_less_sub_5000.npz', images = images, masks = masks)
+    convert(args.root, args.mode, out_file, limit=args.limit, size=args.size, workers=args.workers)
@@ -9,6 +9,8 @@ from sklearn.feature_extraction.image import extract_patches_2d
 from tqdm import tqdm
 import cv2
 
+from util.bitpack import save_bitpacked
+
 
 def read_data_test(study_dir,
                    ref_dir,
@@ -182,10 +184,15 @@ data = data_training
 S = np.sum(data[:,:,:,3],axis=(1,2))
 data = data[S>=1,:,:,:]
 np.savez('/big_disk/ajoshi/ISLES2015/ISEL_28sub_slices_0_182_histeq_nonzeroslices_training64.npz', data=data)
+save_bitpacked('/big_disk/ajoshi/ISLES2015/ISEL_28sub_slices_0_182_histeq_nonzeroslices_training64.pack',
+               np.float16(data[:, :, :, :3]), data[:, :, :, 3])
 
 data = data_testing
 S = np.sum(data[:,:,:,3],axis=(1,2))
 data = data[S>=1,:,:,:]
 np.savez('/big_disk/ajoshi/ISLES2015/ISEL_28sub_slices_0_182_histeq_nonzeroslices_testing64.npz', data=data)
+save_bitpacked('/big_disk/ajoshi/ISLES2015/ISEL_28sub_slices_0_182_histeq_nonzeroslices_testing64.pack',
+               np.float16(data[:, :, :, :3]), data[:, :, :, 3])
+
 
 
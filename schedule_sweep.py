@@ -0,0 +1,124 @@
+""" Run the experiments of a train_qr_sweep config concurrently on one machine
+
+Each job is trained in its own spawned process with a fixed torch thread budget, so a
+many-core CPU box (or several GPUs) runs the subset-size sweep in parallel instead of
+one script after another. The packed training data is memory-mapped read-only, so the
+jobs share its pages. A manifest records every finished job; rerunning the scheduler
+only starts the jobs that are missing, failed or whose config changed.
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict
+from multiprocessing import get_context
+
+import torch
+
+from train_qr_sweep import QRConfig, SweepResources, load_sweep, train_experiment
+
+
+def run_job(cfg_dict, device, threads, loader_workers):
+    logging.basicConfig(level=logging.INFO, format=f'%(levelname)s [{cfg_dict["name"]}]: %(message)s')
+    torch.set_num_threads(threads)
+
+    cfg = QRConfig.from_dict(cfg_dict)
+    resources = SweepResources(torch.device(device), num_workers=loader_workers)
+    start = time.time()
+    result = train_experiment(cfg, resources)
+    result['seconds'] = time.time() - start
+    return result
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(path, manifest):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def is_finished(entry, cfg):
+    return (entry is not None and entry.get('status') == 'done' and entry.get('config') == asdict(cfg)
+            and os.path.exists(cfg.output))
+
+
+def job_devices(device, jobs):
+    if device == 'cuda' and torch.cuda.device_count() > 1:
+        return [f'cuda:{i % torch.cuda.device_count()}' for i in range(jobs)]
+    return [device] * jobs
+
+
+def schedule(configs, manifest_path, jobs, threads=None, device='cpu', loader_workers=1):
+    threads = threads or max((os.cpu_count() or 1) // jobs, 1)
+    manifest = load_manifest(manifest_path)
+    todo = [cfg for cfg in configs if not is_finished(manifest.get(cfg.name), cfg)]
+    logging.info(f'{len(configs) - len(todo)} of {len(configs)} experiments already finished, '
+                 f'running {len(todo)} with {jobs} jobs x {threads} threads')
+    if not todo:
+        return manifest
+
+    devices = job_devices(device, len(todo))
+    # spawn, so no job inherits CUDA state or thread pools from the scheduler
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=get_context('spawn')) as pool:
+        futures = {}
+        for cfg, job_device in zip(todo, devices):
+            futures[pool.submit(run_job, asdict(cfg), job_device, threads, loader_workers)] = cfg
+            manifest[cfg.name] = {'status': 'running', 'config': asdict(cfg), 'device': job_device}
+        write_manifest(manifest_path, manifest)
+
+        for future in as_completed(futures):
+            cfg = futures[future]
+            entry = manifest[cfg.name]
+            try:
+                entry.update(status='done', result=future.result())
+                logging.info(f'{cfg.name} finished: {entry["result"]}')
+            except Exception:
+                entry.update(status='failed', error=traceback.format_exc())
+                logging.error(f'{cfg.name} failed:\n{entry["error"]}')
+            write_manifest(manifest_path, manifest)
+
+    return manifest
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Run a train_qr_sweep config with several concurrent jobs')
+    parser.add_argument('config', type=str, help='JSON list of experiments')
+    parser.add_argument('--manifest', '-m', type=str, default=None,
+                        help='Results manifest (default: <config>.manifest.json)')
+    parser.add_argument('--only', nargs='+', default=None, help='Only run the experiments with these names')
+    parser.add_argument('--jobs', '-j', type=int, default=4, help='Experiments trained at the same time')
+    parser.add_argument('--threads', '-t', type=int, default=None,
+                        help='torch threads per job (default: cores / jobs)')
+    parser.add_argument('--device', choices=['cpu', 'cuda'], default='cpu',
+                        help='Train on CPU, or on the GPUs with jobs spread over them')
+    parser.add_argument('--loader-workers', type=int, default=1, help='DataLoader workers per job')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    configs = load_sweep(args.config)
+    if args.only:
+        configs = [cfg for cfg in configs if cfg.name in args.only]
+
+    manifest_path = args.manifest or os.path.splitext(args.config)[0] + '.manifest.json'
+    manifest = schedule(configs, manifest_path, args.jobs, threads=args.threads, device=args.device,
+                        loader_workers=args.loader_workers)
+
+    failed = [name for name, entry in manifest.items() if entry['status'] != 'done']
+    if failed:
+        logging.error(f'Unfinished experiments: {failed}')
@@ -155,6 +155,8 @@ def get_args():
                         help='Percent of the data that is used as validation (0-100)')
     parser.add_argument('--amp', action='store_true',
                         default=False, help='Use mixed precision')
+    parser.add_argument('--fuse-encoders', action='store_true', default=False,
+                        help='Run the prior and posterior encoders as one grouped convolution pass')
 
     return parser.parse_args()
 
@@ -171,7 +173,7 @@ if __name__ == '__main__':
     # Change here to adapt to your data
     # n_channels=3 for RGB images
     # n_classes is the number of probabilities you want to get per pixel
-    net = ProbabilisticQRUnet(input_channels=1, num_classes=1, num_filters=[32,64,128,192], latent_dim=2, no_convs_fcomb=4, beta=10.0)
+    net = ProbabilisticQRUnet(input_channels=1, num_classes=1, num_filters=[32,64,128,192], latent_dim=2, no_convs_fcomb=4, beta=10.0, fuse_encoders=args.fuse_encoders)
 
 
 
@@ -31,17 +31,6 @@ def BCEqr(P, Y, q):
 
     return torch.sum(-L)
 
-# This is the new cost function
-
-
-def QRcost_new(f, Y, q=0.5):
-    error = f - Y
-    smaller_index = error < 0
-    bigger_index = 0 < error
-    loss = q * torch.sum(torch.abs(error)[smaller_index]) + (1-q) * torch.sum(torch.abs(error)[bigger_index])
-
-    return torch.sum(loss)
-
 def QRcost(f, Y, q=0.5, h=0.1):
     #L = (Y - (1-q))*torch.sigmoid((f-.5)/h)
     L = (Y - (1.0-q))*(f)
@@ -8,14 +8,14 @@ import torch.nn as nn
 import torch.nn.functional as F
 import wandb
 from torch import optim
-from torch.utils.data import DataLoader, random_split, TensorDataset
+from torch.utils.data import DataLoader, random_split, Subset, TensorDataset
 from tqdm import tqdm
 
-from utils.data_loading import BasicDataset, CarvanaDataset
-from utils.dice_score import dice_loss
+from util.bitpack import unpack_masks_tensor
+from util.data_loading import BasicDataset, CarvanaDataset, PackedDataset
+from util.dice_score import dice_loss
 from evaluate import evaluate_grayscale_QR
 from unet import QRUNet
-import numpy as np
 
 dir_img = Path('./data/imgs/')
 dir_mask = Path('./data/masks/')
@@ -66,19 +66,17 @@ def train_net(net,
               amp: bool = False):
     # 1. Create dataset
 
-    d = np.load('/ImagePTE1/ajoshi/code_farm/QRSegment/cone_data_sim_training.npz')
-    X = d['data']
-    M = d['masks']
-    X = np.expand_dims(X, axis=3)
-    M = np.expand_dims(M, axis=3)
-
-    X = np.concatenate((X, M), axis=3)
+    # masks are bit-packed on disk (make_cones_data.py) and stay packed until they reach the device
+    data_file = '/ImagePTE1/ajoshi/code_farm/QRSegment/cone_data_sim_training.pack'
+    X = PackedDataset(data_file, keep_packed=True)
 
     # 2. Split into train / validation partitions
     n_val = int(len(X) * val_percent)
     n_train = len(X) - n_val
-    train_set, val_set = random_split(
-        X, [n_train, n_val], generator=torch.Generator().manual_seed(0))
+    train_idx, val_idx = random_split(
+        range(len(X)), [n_train, n_val], generator=torch.Generator().manual_seed(0))
+    train_set = Subset(X, train_idx.indices)
+    val_set = Subset(PackedDataset(data_file), val_idx.indices)
 
     # 3. Create data loaders
     loader_args = dict(batch_size=batch_size, num_workers=4, pin_memory=True)
@@ -120,17 +118,16 @@ def train_net(net,
         epoch_loss = 0
         with tqdm(total=n_train, desc=f'Epoch {epoch + 1}/{epochs}', unit='img') as pbar:
             for batch in train_loader:
-                images = batch[:, :, :, np.newaxis, 0].permute(
-                    (0, 3, 1, 2))  # ['image']
-                true_masks = batch[:, :, :, 1]  # batch['mask']
+                images = batch['image']
+                true_masks = batch['mask']
 
                 assert images.shape[1] == net.n_channels, \
                     f'Network has been defined with {net.n_channels} input channels, ' \
                     f'but loaded images have {images.shape[1]} channels. Please check that ' \
                     'the images are loaded correctly.'
 
-                images = images.to(device=device, dtype=torch.float32)
-                true_masks = true_masks.to(device=device, dtype=torch.float32)
+                images = images.to(device=device, dtype=torch.float32, non_blocking=True)
+                true_masks = unpack_masks_tensor(true_masks.to(device=device, non_blocking=True), X.width)
 
                 with torch.cuda.amp.autocast(enabled=amp):
                     masks_pred1, masks_pred2, masks_pred3 = net(images)
@@ -0,0 +1,321 @@
+""" Train several QR U-Net experiments in one process
+
+Replaces the copy-pasted train_qr_LIDC_4Q*.py / train_qr_BCE_4Q*.py scripts.
+An experiment is a QRConfig (data file, losses, quantiles, output name, ...); a sweep
+is a JSON list of them, see configs/lidc_4q_sweep.json. The former single-run scripts
+are, for example,
+
+    python train_qr_sweep.py --name LIDC_4Q_QR_1000 --epochs 5 --raters random \
+        --data /big_disk/ajoshi/LIDC_data/train_less_sub_1000_raters.pack
+    python train_qr_sweep.py --name LIDC_4Q_BCE_1000 --epochs 5 --loss bce \
+        --data /big_disk/ajoshi/LIDC_data/train_less_sub_1000.pack
+
+ Datasets, DataLoader worker
+pools and the (optionally compiled) network are created once and reused by every
+experiment that can share them, and each experiment restarts from the same initial
+weights.
+"""
+
+import argparse
+import copy
+import json
+import logging
+import sys
+from dataclasses import asdict, dataclass, field, fields
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import torch
+import wandb
+from torch import optim
+from torch.utils.data import DataLoader, Subset, random_split
+from tqdm import tqdm
+
+from evaluate import evaluate_heads, grayscale_batch, rater_batch, rater_mean_batch
+from unet import QRUNet_4Q
+from util.data_loading import LIDCRaterDataset, PackedDataset
+from util.qr_loss import QuantileLoss, criteria
+
+dir_checkpoint = Path('./checkpoints/')
+
+
+@dataclass
+class QRConfig:
+    name: str
+    data: str
+    raters: Optional[str] = None  # 'random' or 'mean' to train on a rater-axis file from save_LIDC_data.py
+    loss: str = 'qr'
+    warmup_loss: str = 'bce_w'
+    warmup_epochs: int = 1
+    quantiles: List[float] = field(default_factory=lambda: [0.875, 0.625, 0.375, 0.125])
+    monotone: bool = False  # non-crossing quantile heads, QRUNet_4Q(monotone=True)
+    epochs: int = 20
+    batch_size: int = 40
+    learning_rate: float = 1e-5
+    val_percent: float = 0.1
+    save_checkpoint: bool = True
+    init_weights: Optional[str] = None  # start from these weights instead of the shared initial ones
+    init_output: Optional[str] = None  # weights after the first epoch
+    history_output: Optional[str] = None  # per-epoch loss and validation Dice
+    output: Optional[str] = None
+    amp: bool = False
+
+    def __post_init__(self):
+        for loss in (self.loss, self.warmup_loss):
+            assert loss in criteria, f'Unknown loss {loss}, expected one of {list(criteria)}'
+        assert self.raters in (None, 'random', 'mean'), f'Unknown rater mode {self.raters}'
+        if self.output is None:
+            self.output = f'{self.name}.pth'
+
+    @classmethod
+    def from_dict(cls, d):
+        known = {f.name for f in fields(cls)}
+        unknown = set(d) - known
+        assert not unknown, f'Unknown experiment settings {sorted(unknown)}'
+        return cls(**d)
+
+
+def load_sweep(path):
+    with open(path) as f:
+        return [QRConfig.from_dict(d) for d in json.load(f)]
+
+
+class SweepResources:
+    """Datasets, loaders and the network shared by the experiments of a sweep"""
+
+    def __init__(self, device, num_workers=4, compile=False):
+        self.device = device
+        self.num_workers = num_workers
+        self.compile = compile
+        self.datasets = {}
+        self.loaders = {}
+        self.nets = {}
+
+    def dataset(self, path, raters=None):
+        if (path, raters) not in self.datasets:
+            if raters is None:
+                self.datasets[path, raters] = PackedDataset(path)
+            else:
+                self.datasets[path, raters] = LIDCRaterDataset(path, mode=raters)
+        return self.datasets[path, raters]
+
+    def data_loaders(self, cfg):
+        """Training and validation loaders of an experiment, and the batch_fn to score the validation batches"""
+        key = (cfg.data, cfg.raters, cfg.batch_size, cfg.val_percent)
+        if key not in self.loaders:
+            dataset = self.dataset(cfg.data, cfg.raters)
+            n_val = int(len(dataset) * cfg.val_percent)
+            n_train = len(dataset) - n_val
+            train_set, val_set = random_split(
+                dataset, [n_train, n_val], generator=torch.Generator().manual_seed(0))
+            val_batch = grayscale_batch
+            if cfg.raters is not None:
+                # validate on all raters of each slice (or their mean thresholded at 0.5),
+                # not on a rater drawn anew every round
+                val_set = Subset(self.dataset(cfg.data, 'soft'), val_set.indices)
+                val_batch = rater_mean_batch if cfg.raters == 'mean' else rater_batch
+
+            # persistent workers are kept alive for the next experiment on the same data
+            loader_args = dict(batch_size=cfg.batch_size, num_workers=self.num_workers,
+                               pin_memory=self.device.type == 'cuda',
+                               persistent_workers=self.num_workers > 0)
+            self.loaders[key] = (DataLoader(train_set, shuffle=False, **loader_args),
+                                 DataLoader(val_set, shuffle=False, drop_last=True, **loader_args), val_batch)
+        return self.loaders[key]
+
+    def network(self, n_quantiles, monotone=False):
+        """Network reset to its initial weights, together with the module to call for training"""
+        assert n_quantiles == 4, 'Only the four quantile QRUNet_4Q is supported'
+        key = (n_quantiles, monotone)
+        if key not in self.nets:
+            net = QRUNet_4Q(n_channels=1, n_classes=2, bilinear=True, monotone=monotone).to(device=self.device)
+            model = torch.compile(net) if self.compile else net
+            self.nets[key] = (net, model, copy.deepcopy(net.state_dict()))
+
+        net, model, init_state = self.nets[key]
+        net.load_state_dict(init_state)
+        return net, model
+
+
+def train_experiment(cfg: QRConfig, resources: SweepResources):
+    device = resources.device
+    net, model = resources.network(len(cfg.quantiles), cfg.monotone)
+    if cfg.init_weights:
+        net.load_state_dict(torch.load(cfg.init_weights, map_location=device))
+    train_loader, val_loader, val_batch = resources.data_loaders(cfg)
+    n_train = len(train_loader.dataset)
+    n_val = len(val_loader.dataset)
+
+    experiment = wandb.init(project='U-Net', resume='allow', anonymous='must', name=cfg.name, reinit=True)
+    experiment.config.update(asdict(cfg))
+
+    logging.info(f'''Starting training {cfg.name}:
+        Data:            {cfg.data}
+        Rater targets:   {cfg.raters}
+        Loss:            {cfg.warmup_loss} for {cfg.warmup_epochs} epoch(s), then {cfg.loss}
+        Quantiles:       {cfg.quantiles}
+        Monotone heads:  {cfg.monotone}
+        Epochs:          {cfg.epochs}
+        Batch size:      {cfg.batch_size}
+        Learning rate:   {cfg.learning_rate}
+        Training size:   {n_train}
+        Validation size: {n_val}
+        Checkpoints:     {cfg.save_checkpoint}
+        Device:          {device.type}
+        Mixed Precision: {cfg.amp}
+    ''')
+
+    optimizer = optim.RMSprop(net.parameters(), lr=cfg.learning_rate, weight_decay=1e-8, momentum=0.9)
+    scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'max', patience=2)  # goal: maximize Dice score
+    grad_scaler = torch.cuda.amp.GradScaler(enabled=cfg.amp)
+    global_step = 0
+
+    loss_epochs = np.zeros(cfg.epochs)
+    val_dice_epochs = np.zeros(cfg.epochs)
+    val_score = torch.zeros(())
+    warmup_criterion = QuantileLoss(cfg.quantiles, cfg.warmup_loss).to(device)
+    main_criterion = QuantileLoss(cfg.quantiles, cfg.loss).to(device)
+
+    for epoch in range(cfg.epochs):
+        criterion = warmup_criterion if epoch < cfg.warmup_epochs else main_criterion
+
+        net.train()
+        epoch_loss = 0
+        with tqdm(total=n_train, desc=f'{cfg.name} epoch {epoch + 1}/{cfg.epochs}', unit='img') as pbar:
+            for batch in train_loader:
+                images = batch[:, :, :, np.newaxis, 0].permute((0, 3, 1, 2))
+                true_masks = batch[:, :, :, 1]
+
+                images = images.to(device=device, dtype=torch.float32)
+                true_masks = true_masks.to(device=device, dtype=torch.float32)
+
+                with torch.cuda.amp.autocast(enabled=cfg.amp):
+                    masks_pred = model(images)
+                    # foreground channel of every head, (B, Q, H, W)
+                    loss = criterion(torch.stack([pred[:, 1] for pred in masks_pred], dim=1), true_masks)
+
+                optimizer.zero_grad(set_to_none=True)
+                grad_scaler.scale(loss).backward()
+                grad_scaler.step(optimizer)
+                grad_scaler.update()
+
+                pbar.update(images.shape[0])
+                global_step += 1
+                epoch_loss += loss.item()
+                experiment.log({
+                    'train loss': loss.item(),
+                    'step': global_step,
+                    'epoch': epoch
+                })
+                pbar.set_postfix(**{'loss (batch)': loss.item()})
+
+                # Evaluation round
+                if global_step % max(n_train // (10 * cfg.batch_size), 1) == 0:
+                    histograms = {}
+                    for tag, value in net.named_parameters():
+                        tag = tag.replace('/', '.')
+                        histograms['Weights/' + tag] = wandb.Histogram(value.data.cpu())
+                        histograms['Gradients/' + tag] = wandb.Histogram(value.grad.data.cpu())
+
+                    # every head in one validation round, the third (q=0.375) drives the scheduler
+                    head_scores = evaluate_heads(net, val_loader, device, val_batch)
+                    val_score = head_scores[2]
+                    scheduler.step(val_score)
+
+                    logging.info('Validation Dice score: {}'.format(val_score))
+                    experiment.log({
+                        'learning rate': optimizer.param_groups[0]['lr'],
+                        'validation Dice': val_score,
+                        **{f'validation Dice q={q}': score for q, score in zip(cfg.quantiles, head_scores.tolist())},
+                        'images': wandb.Image(images[0, 0].cpu()),
+                        'masks': {
+                            'true': wandb.Image(true_masks[0].float().cpu()),
+                            **{f'pred{k + 1}': wandb.Image((pred[0, 1] > 0.5).float().cpu())
+                               for k, pred in enumerate(masks_pred)},
+                        },
+                        'step': global_step,
+                        'epoch': epoch,
+                        **histograms
+                    })
+
+        loss_epochs[epoch] = epoch_loss
+        val_dice_epochs[epoch] = float(val_score)
+
+        if epoch == 0 and cfg.init_output:
+            torch.save(net.state_dict(), cfg.init_output)
+
+        if cfg.save_checkpoint:
+            checkpoint_dir = dir_checkpoint / cfg.name
+            checkpoint_dir.mkdir(parents=True, exist_ok=True)
+            torch.save(net.state_dict(), str(checkpoint_dir / 'checkpoint_epoch{}.pth'.format(epoch + 1)))
+            logging.info(f'Checkpoint {epoch + 1} saved!')
+
+    if cfg.history_output:
+        np.savez(cfg.history_output, loss_epochs=loss_epochs, val_dice_epochs=val_dice_epochs)
+
+    torch.save(net.state_dict(), cfg.output)
+    experiment.finish()
+    logging.info(f'{cfg.name} saved to {cfg.output}')
+
+    return {'output': cfg.output, 'final_loss': float(loss_epochs[-1]), 'val_dice': float(val_score)}
+
+
+def run_sweep(configs, device, num_workers=4, compile=False):
+    resources = SweepResources(device, num_workers=num_workers, compile=compile)
+    return {cfg.name: train_experiment(cfg, resources) for cfg in configs}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Train one or more QR U-Net experiments in a single process')
+    parser.add_argument('--config', '-c', type=str, default=None, help='JSON list of experiments')
+    parser.add_argument('--only', nargs='+', default=None, help='Only run the experiments with these names')
+    parser.add_argument('--name', type=str, default='LIDC_4Q_QR', help='Experiment name (without --config)')
+    parser.add_argument('--data', type=str, default=None, help='Packed training data (without --config)')
+    parser.add_argument('--raters', choices=['random', 'mean'], default=None,
+                        help='--data is a rater-axis file, train on a randomly drawn rater per slice '
+                             '(validated against every rater) or on the rater mean (validated against '
+                             'the mean thresholded at 0.5)')
+    parser.add_argument('--load', '-f', type=str, default=None, help='Start from the weights in a .pth file')
+    parser.add_argument('--loss', choices=list(criteria), default='qr', help='Loss after the warmup epochs')
+    parser.add_argument('--warmup-loss', choices=list(criteria), default='bce_w', help='Loss of the warmup epochs')
+    parser.add_argument('--monotone', action='store_true', default=False,
+                        help='Non-crossing quantile heads (QRUNet_4Q(monotone=True))')
+    parser.add_argument('--epochs', '-e', metavar='E', type=int, default=20, help='Number of epochs')
+    parser.add_argument('--batch-size', '-b', dest='batch_size', metavar='B', type=int, default=40,
+                        help='Batch size')
+    parser.add_argument('--learning-rate', '-l', metavar='LR', type=float, default=0.00001,
+                        help='Learning rate', dest='lr')
+    parser.add_argument('--validation', '-v', dest='val', type=float, default=10.0,
+                        help='Percent of the data that is used as validation (0-100)')
+    parser.add_argument('--amp', action='store_true', default=False, help='Use mixed precision')
+    parser.add_argument('--workers', type=int, default=4, help='DataLoader workers per dataset')
+    parser.add_argument('--compile', action='store_true', default=False, help='torch.compile the network once')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    if args.config:
+        configs = load_sweep(args.config)
+        if args.only:
+            configs = [cfg for cfg in configs if cfg.name in args.only]
+    elif args.data:
+        configs = [QRConfig(name=args.name, data=args.data, raters=args.raters, loss=args.loss,
+                            warmup_loss=args.warmup_loss, monotone=args.monotone, epochs=args.epochs,
+                            batch_size=args.batch_size, learning_rate=args.lr, val_percent=args.val / 100,
+                            init_weights=args.load, amp=args.amp)]
+    else:
+        sys.exit('Either --config or --data is required')
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    logging.info(f'Using device {device}')
+
+    try:
+        run_sweep(configs, device, num_workers=args.workers, compile=args.compile)
+    except KeyboardInterrupt:
+        logging.info('Interrupted')
+        sys.exit(0)
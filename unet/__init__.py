@@ -1 +1 @@
-from .unet_model import UNet, QRUNet,QRUNet_4Q
+from .unet_model import UNet, QRUNet, QRUNet_4Q, QRUNetN
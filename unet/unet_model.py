@@ -75,11 +75,18 @@ class QRUNet(nn.Module):
 
 
 class QRUNet_4Q(nn.Module):
-    def __init__(self, n_channels, n_classes, bilinear=True):
+    """QR U-Net with four quantile heads
+
+    With monotone=True (two classes only) the heads share one MonotoneQuantileOutConv,
+    so the masks of heads 1..4 are nested by construction.
+    """
+
+    def __init__(self, n_channels, n_classes, bilinear=True, monotone=False):
         super(QRUNet_4Q, self).__init__()
         self.n_channels = n_channels
         self.n_classes = n_classes
         self.bilinear = bilinear
+        self.monotone = monotone
 
         self.inc = DoubleConv(n_channels, 64)
         self.down1 = Down(64, 128)
@@ -91,10 +98,14 @@ class QRUNet_4Q(nn.Module):
         self.up2 = Up(512, 256 // factor, bilinear)
         self.up3 = Up(256, 128 // factor, bilinear)
         self.up4 = Up(128, 64, bilinear)
-        self.outc1 = OutConv(64, n_classes)
-        self.outc2 = OutConv(64, n_classes)
-        self.outc3 = OutConv(64, n_classes)
-        self.outc4 = OutConv(64, n_classes)
+        if monotone:
+            assert n_classes == 2, 'Monotone quantile heads need n_classes=2'
+            self.outq = MonotoneQuantileOutConv(64, 4)
+        else:
+            self.outc1 = OutConv(64, n_classes)
+            self.outc2 = OutConv(64, n_classes)
+            self.outc3 = OutConv(64, n_classes)
+            self.outc4 = OutConv(64, n_classes)
 
     def forward(self, x):
         x1 = self.inc(x)
@@ -106,8 +117,91 @@ class QRUNet_4Q(nn.Module):
         x = self.up2(x, x3)
         x = self.up3(x, x2)
         x = self.up4(x, x1)
+        if self.monotone:
+            return self.outq(x).unbind(1)
         logits1 = self.outc1(x)
         logits2 = self.outc2(x)
         logits3 = self.outc3(x)
         logits4 = self.outc4(x)
-        return logits1, logits2, logits3,logits4
\ No newline at end of file
+        return logits1, logits2, logits3,logits4
+
+
+def default_quantiles(n_quantiles):
+    """Bin centres from high to low, e.g. 0.875, 0.625, 0.375, 0.125 for four quantiles"""
+    return [1.0 - (k + 0.5) / n_quantiles for k in range(n_quantiles)]
+
+
+class QRUNetN(nn.Module):
+    """QR U-Net with any number of quantile heads computed by a single 1x1 convolution
+
+    forward returns one (B, Q, C, H, W) tensor, head k being the mask for quantiles[k].
+    Checkpoints of QRUNet / QRUNet_4Q can be loaded after convert_state_dict.
+    monotone=True uses MonotoneQuantileOutConv, with quantiles from high to low.
+    """
+
+    def __init__(self, n_channels, n_classes, n_quantiles=4, quantiles=None, bilinear=True, monotone=False):
+        super(QRUNetN, self).__init__()
+        if quantiles is None:
+            quantiles = default_quantiles(n_quantiles)
+        assert len(quantiles) == n_quantiles, f'Got {len(quantiles)} quantiles for {n_quantiles} heads'
+        self.n_channels = n_channels
+        self.n_classes = n_classes
+        self.n_quantiles = n_quantiles
+        self.quantiles = [float(q) for q in quantiles]
+        self.bilinear = bilinear
+        self.monotone = monotone
+
+        self.inc = DoubleConv(n_channels, 64)
+        self.down1 = Down(64, 128)
+        self.down2 = Down(128, 256)
+        self.down3 = Down(256, 512)
+        factor = 2 if bilinear else 1
+        self.down4 = Down(512, 1024 // factor)
+        self.up1 = Up(1024, 512 // factor, bilinear)
+        self.up2 = Up(512, 256 // factor, bilinear)
+        self.up3 = Up(256, 128 // factor, bilinear)
+        self.up4 = Up(128, 64, bilinear)
+        if monotone:
+            assert n_classes == 2, 'Monotone quantile heads need n_classes=2'
+            assert self.quantiles == sorted(self.quantiles, reverse=True), 'Monotone heads need decreasing quantiles'
+            self.outc = MonotoneQuantileOutConv(64, n_quantiles)
+        else:
+            self.outc = QuantileOutConv(64, n_classes, n_quantiles)
+
+    def forward(self, x):
+        x1 = self.inc(x)
+        x2 = self.down1(x1)
+        x3 = self.down2(x2)
+        x4 = self.down3(x3)
+        x5 = self.down4(x4)
+        x = self.up1(x5, x4)
+        x = self.up2(x, x3)
+        x = self.up3(x, x2)
+        x = self.up4(x, x1)
+        return self.outc(x)
+
+    def quantile_index(self, q):
+        for k, qk in enumerate(self.quantiles):
+            if abs(qk - q) < 1e-6:
+                return k
+        raise KeyError(f'No head for quantile {q}, the model has {self.quantiles}')
+
+    def select(self, logits, q):
+        """(B, C, H, W) output of the head for quantile q"""
+        return logits[:, self.quantile_index(q)]
+
+    @staticmethod
+    def heads(logits):
+        """Per-head outputs as the tuple QRUNet / QRUNet_4Q return"""
+        return logits.unbind(1)
+
+    @staticmethod
+    def convert_state_dict(state_dict, n_quantiles=None):
+        """Map a QRUNet / QRUNet_4Q state dict (outc1..outcQ) onto the fused QRUNetN head"""
+        if n_quantiles is None:
+            n_quantiles = len({k.split('.')[0] for k in state_dict if k.startswith('outc')})
+        converted = {k: v for k, v in state_dict.items() if not k.startswith('outc')}
+        for name in ('weight', 'bias'):
+            converted[f'outc.conv.{name}'] = torch.cat(
+                [state_dict[f'outc{k + 1}.conv.0.{name}'] for k in range(n_quantiles)], dim=0)
+        return converted
@@ -77,3 +77,48 @@ class OutConv(nn.Module):
 
     def forward(self, x):
         return self.conv(x)
+
+
+class QuantileOutConv(nn.Module):
+    """One 1x1 convolution for all quantile heads, (B, Q, C, H, W) softmax over the classes"""
+
+    def __init__(self, in_channels, out_channels, n_quantiles):
+        super(QuantileOutConv, self).__init__()
+        self.out_channels = out_channels
+        self.n_quantiles = n_quantiles
+        self.conv = nn.Conv2d(in_channels, n_quantiles * out_channels, kernel_size=1)
+
+    def forward(self, x):
+        logits = self.conv(x)
+        logits = logits.view(logits.shape[0], self.n_quantiles, self.out_channels, *logits.shape[2:])
+        return torch.softmax(logits, dim=2)
+
+
+def cumulative_quantile_logits(raw):
+    """Ordered foreground logits from a base logit plus non-negative increments
+
+    raw is (B, Q, H, W): channel 0 is the logit of the last (smallest mask) head and
+    softplus of channels 1.. are added cumulatively towards the first head, so
+    logits[:, 0] >= logits[:, 1] >= ... >= logits[:, Q - 1] everywhere.
+    """
+    base = raw[:, :1]
+    steps = F.softplus(raw[:, 1:])
+    return torch.cat([base, base + torch.cumsum(steps, dim=1)], dim=1).flip(1)
+
+
+class MonotoneQuantileOutConv(nn.Module):
+    """Two-class quantile heads that cannot cross, (B, Q, 2, H, W)
+
+    Head k predicts foreground with probability sigmoid(logit_k) and the logits are
+    ordered by construction (cumulative_quantile_logits), so the thresholded mask of
+    every head contains the mask of the next one.
+    """
+
+    def __init__(self, in_channels, n_quantiles):
+        super(MonotoneQuantileOutConv, self).__init__()
+        self.n_quantiles = n_quantiles
+        self.conv = nn.Conv2d(in_channels, n_quantiles, kernel_size=1)
+
+    def forward(self, x):
+        p = torch.sigmoid(cumulative_quantile_logits(self.conv(x)))
+        return torch.stack([1 - p, p], dim=2)
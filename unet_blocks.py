@@ -56,4 +56,49 @@ class UpConvBlock(nn.Module):
         out = torch.cat([up, bridge], 1)
         out =  self.conv_block(out)
 
-        return out
\ No newline at end of file
+        return out
+
+
+def latent_conv1x1_parts(conv, feature_map, z):
+    """
+    The two terms of conv applied to feature_map concatenated with z tiled over every pixel.
+    The weights of conv (a 1x1 convolution over no_channels+latent_dim inputs) are split in a feature part,
+    applied as a convolution (batch_size x out_channels x H x W), and a latent part, which turns z
+    (... x latent_dim, e.g. batch_size x n_samples x latent_dim) into a bias of shape ... x out_channels.
+    """
+    num_features = feature_map.shape[1]
+    weight_features, weight_z = conv.weight.split([num_features, conv.in_channels - num_features], dim=1)
+    bias = torch.nn.functional.linear(z, weight_z.flatten(1), conv.bias)
+    return torch.nn.functional.conv2d(feature_map, weight_features), bias
+
+
+def latent_conv1x1(conv, feature_map, z):
+    """
+    conv applied to feature_map concatenated with z tiled over every pixel, without building the tiled tensor:
+    the latent enters as a per sample bias added by broadcasting.
+    """
+    features, bias = latent_conv1x1_parts(conv, feature_map, z)
+    return features + bias[:, :, None, None]
+
+
+def decode_latent_samples(layers, last_layer, feature_map, z, chunk_size=None):
+    """
+    Decode several latent samples per image with the 1x1 convolutions of an Fcomb.
+    z is batch_size x n_samples x latent_dim, layers the Fcomb layers (first one the latent 1x1 convolution) and
+    last_layer maps their output to the predictions. The feature term of the first convolution is computed once
+    per image and the rest runs on at most chunk_size (image, sample) pairs at a time.
+    Returns batch_size x n_samples x ... x H x W.
+    """
+    batch_size, n_samples = z.shape[:2]
+    features, bias = latent_conv1x1_parts(layers[0], feature_map, z)
+    bias = bias.flatten(0, 1)
+    image_index = torch.arange(batch_size, device=features.device).repeat_interleave(n_samples)
+    chunk_size = chunk_size or batch_size * n_samples
+
+    outputs = []
+    for start in range(0, batch_size * n_samples, chunk_size):
+        end = start + chunk_size
+        output = features[image_index[start:end]] + bias[start:end, :, None, None]
+        outputs.append(last_layer(layers[1:](output)))
+    output = torch.cat(outputs)
+    return output.view(batch_size, n_samples, *output.shape[1:])
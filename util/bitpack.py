@@ -0,0 +1,39 @@
+""" Binary masks stored 8 pixels per byte along the last (width) axis
+
+Masks are packed with np.packbits (most significant bit first) when a dataset is
+written, travel through the DataLoader still packed, and are only expanded on the
+training device by unpack_masks_tensor.
+"""
+
+import numpy as np
+import torch
+
+from .packed import save_packed
+
+
+def packed_width(width):
+    return (width + 7) // 8
+
+
+def pack_masks(masks):
+    return np.packbits(np.asarray(masks) > 0, axis=-1)
+
+
+def unpack_masks(packed, width):
+    return np.unpackbits(packed, axis=-1, count=width)
+
+
+def unpack_masks_tensor(packed, width, dtype=torch.float32):
+    """Expand a uint8 (..., ceil(width / 8)) tensor of packed bits to (..., width) of dtype"""
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=packed.device)
+    bits = (packed.unsqueeze(-1) >> shifts) & 1
+    return bits.flatten(-2)[..., :width].to(dtype)
+
+
+def save_bitpacked(path, images, masks, meta=None, chunk=1024):
+    """Write images and binary masks to a packed file with the masks bit-packed"""
+    meta = dict(meta or {}, mask_width=masks.shape[-1])
+    packed = np.empty(masks.shape[:-1] + (packed_width(masks.shape[-1]),), dtype=np.uint8)
+    for start in range(0, len(masks), chunk):
+        packed[start:start + chunk] = pack_masks(masks[start:start + chunk])
+    return save_packed(path, meta=meta, chunk=chunk, images=images, masks=packed)
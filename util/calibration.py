@@ -0,0 +1,133 @@
+""" Assigning pixels to the bins between the quantile masks of a QR model
+
+Heads are ordered from the largest mask (highest quantile, e.g. 0.875) to the
+smallest. Bin 0 lies outside every mask, bin k between the masks of heads k - 1
+and k, and bin Q inside all of them.
+"""
+
+import torch
+
+
+def quantile_bin_masks(probs, threshold=0.5):
+    """(B, Q, H, W) foreground probabilities to (B, Q + 1, H, W) bool bin masks
+
+    Same definition as the pairwise tests of the calibration scripts, bin k is
+    probs[k - 1] >= threshold and probs[k] < threshold, so it is also valid when the
+    heads cross (a pixel can then fall in several bins or none).
+    """
+    inside = probs >= threshold
+    ones = torch.ones_like(inside[:, :1])
+    inside = torch.cat([ones, inside, ~ones], dim=1)
+    return inside[:, :-1] & ~inside[:, 1:]
+
+
+def quantile_bin_index(probs, threshold=0.5):
+    """(B, Q, H, W) foreground probabilities of ordered heads to a (B, H, W) bin index
+
+    For heads whose masks are nested, e.g. QRUNet_4Q(monotone=True), a pixel lies in
+    exactly one bin, the number of masks containing it, so one pass replaces the
+    pairwise comparisons of quantile_bin_masks.
+    """
+    return (probs >= threshold).sum(dim=1)
+
+
+class CalibrationAccumulator:
+    """Streaming reliability diagram of a QR model with any sorted set of quantiles
+
+    quantiles are those of the heads, from the largest mask down, e.g. [0.875, 0.625,
+    0.375, 0.125]. A head for quantile q marks the pixels whose foreground probability
+    exceeds 1 - q, so bin k (see quantile_bin_index) should hold a fraction of positive
+    pixels between 1 - quantiles[k - 1] and 1 - quantiles[k]. Counts are kept per bin
+    on the device of the first batch; accumulators of separate workers are combined
+    with merge and turned into an expected vs observed table by finalize.
+
+    Pixels are binned with the pairwise tests of quantile_bin_masks, like the
+    calibration scripts, so heads that cross give the same table there and here. With
+    nested=True, for models that guarantee nested masks (monotone=True), they are
+    binned by the number of masks containing them instead, one bincount per batch.
+    """
+
+    def __init__(self, quantiles, threshold=0.5, nested=False):
+        quantiles = [float(q) for q in quantiles]
+        assert quantiles == sorted(quantiles, reverse=True), f'Quantiles must be sorted high to low, got {quantiles}'
+        self.quantiles = quantiles
+        self.threshold = threshold
+        self.nested = nested
+        self.n_bins = len(quantiles) + 1
+        self.pixels = None      # pixels in each bin
+        self.positives = None   # positive target pixels in each bin
+        self.rate_sum = None    # per-image positive rates, summed over the images
+        self.images = None      # images in which the bin is not empty
+
+    def _zeros(self, device):
+        self.pixels = torch.zeros(self.n_bins, dtype=torch.float64, device=device)
+        self.positives = torch.zeros_like(self.pixels)
+        self.rate_sum = torch.zeros_like(self.pixels)
+        self.images = torch.zeros(self.n_bins, dtype=torch.long, device=device)
+
+    def update(self, probs, target):
+        """Add a batch of (B, Q, H, W) foreground probabilities and its (B, H, W) target"""
+        assert probs.shape[1] == len(self.quantiles), \
+            f'Got {probs.shape[1]} heads for {len(self.quantiles)} quantiles'
+        if self.pixels is None:
+            self._zeros(probs.device)
+
+        if self.nested:
+            batch_size = probs.shape[0]
+            index = quantile_bin_index(probs, self.threshold)
+            # one bin per (image, bin) pair so per-image rates come out of the same pass
+            index = index + self.n_bins * torch.arange(batch_size, device=index.device).view(-1, 1, 1)
+            index = index.flatten()
+            size = batch_size * self.n_bins
+            pixels = torch.bincount(index, minlength=size).view(batch_size, self.n_bins).double()
+            positives = torch.bincount(index, weights=target.flatten().double(), minlength=size)
+            positives = positives.view(batch_size, self.n_bins)
+        else:
+            bins = quantile_bin_masks(probs, self.threshold).double()
+            pixels = bins.sum(dim=(2, 3))
+            positives = torch.einsum('bkhw,bhw->bk', bins, target.double())
+
+        self.pixels += pixels.sum(dim=0)
+        self.positives += positives.sum(dim=0)
+        self.rate_sum += (positives / pixels.clamp(min=1)).sum(dim=0)
+        self.images += (pixels > 0).sum(dim=0)
+        return self
+
+    def merge(self, other):
+        """Add the counts of another accumulator for the same quantiles"""
+        assert other.quantiles == self.quantiles and other.threshold == self.threshold and other.nested == self.nested
+        if other.pixels is None:
+            return self
+        if self.pixels is None:
+            self._zeros(other.pixels.device)
+        for name in ('pixels', 'positives', 'rate_sum', 'images'):
+            getattr(self, name).add_(getattr(other, name).to(self.pixels.device))
+        return self
+
+    def finalize(self):
+        """One row per bin with its expected range of positive rates and the observed rates
+
+        observed pools all pixels of the bin, observed_per_image averages the rate of
+        every image in which the bin is not empty (the q*_p of the calibration scripts).
+        """
+        assert self.pixels is not None, 'No batches were added'
+        bounds = [0.0] + [1.0 - q for q in self.quantiles] + [1.0]
+        pixels = self.pixels.tolist()
+        positives = self.positives.tolist()
+        rate_sum = self.rate_sum.tolist()
+        images = self.images.tolist()
+
+        rows = []
+        for k in range(self.n_bins):
+            lower, upper = bounds[k], bounds[k + 1]
+            rows.append({
+                'bin': k,
+                'lower': lower,
+                'upper': upper,
+                'expected': (lower + upper) / 2,
+                'observed': positives[k] / pixels[k] if pixels[k] else float('nan'),
+                'observed_per_image': rate_sum[k] / images[k] if images[k] else float('nan'),
+                'pixels': int(pixels[k]),
+                'images': images[k],
+            })
+        return rows
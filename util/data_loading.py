@@ -8,6 +8,9 @@ import torch
 from PIL import Image
 from torch.utils.data import Dataset
 
+from .bitpack import unpack_masks
+from .packed import open_packed, read_header
+
 
 class BasicDataset(Dataset):
     def __init__(self, images_dir: str, masks_dir: str, scale: float = 1.0, mask_suffix: str = ''):
@@ -78,3 +81,121 @@ class BasicDataset(Dataset):
 class CarvanaDataset(BasicDataset):
     def __init__(self, images_dir, masks_dir, scale=1):
         super().__init__(images_dir, masks_dir, scale, mask_suffix='_mask')
+
+
+class PackedDataset(Dataset):
+    """Images and masks memory-mapped from a packed file written by util.packed
+
+    Each item is laid out like the arrays the training scripts used to build with
+    np.concatenate, (H, W, C + 1) float32 with the C image channels first and the mask
+    last, so it can be handed to random_split and the existing train_net loops.
+    Images may be stored (N, H, W) or channel-last (N, H, W, C).
+
+    Masks stored bit-packed (see util.bitpack, the header then records mask_width) are
+    unpacked per item, or with keep_packed=True returned as they are in
+    {'image': (C, H, W), 'mask': (H, ceil(W / 8)) uint8} items, to be expanded on the
+    training device with unpack_masks_tensor.
+    """
+
+    def __init__(self, path: str, image_key: str = 'images', mask_key: str = 'masks', keep_packed: bool = False):
+        self.path = Path(path)
+        self.image_key = image_key
+        self.mask_key = mask_key
+
+        header = read_header(self.path)
+        arrays = header['arrays']
+        self.length = arrays[image_key]['shape'][0]
+        assert arrays[mask_key]['shape'][0] == self.length, \
+            f'{path} has {self.length} images but {arrays[mask_key]["shape"][0]} masks'
+        self.width = header['meta'].get('mask_width')
+        assert self.width is not None or not keep_packed, f'Masks in {path} are not bit-packed'
+        self.keep_packed = keep_packed
+        self._arrays = None
+        logging.info(f'Creating dataset with {self.length} examples from {path}')
+
+    def __len__(self):
+        return self.length
+
+    def __getstate__(self):
+        # workers map the file themselves rather than receiving a pickled copy
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays, _ = open_packed(self.path)
+        return self._arrays
+
+    @staticmethod
+    def stack(img, target):
+        """(H, W[, C]) image and (K, H, W) target to a (H, W, C + K) float32 item"""
+        if img.ndim == 2:
+            img = img[..., np.newaxis]
+        item = np.empty(img.shape[:2] + (img.shape[2] + len(target),), dtype=np.float32)
+        item[..., :img.shape[2]] = img
+        item[..., img.shape[2]:] = np.moveaxis(target, 0, -1)
+        return item
+
+    @staticmethod
+    def packed_item(img, bits):
+        img = img[np.newaxis] if img.ndim == 2 else np.moveaxis(img, -1, 0)
+        return {
+            'image': torch.as_tensor(np.ascontiguousarray(img)),
+            'mask': torch.as_tensor(np.ascontiguousarray(bits))
+        }
+
+    def __getitem__(self, idx):
+        img = self.arrays[self.image_key][idx]
+        mask = self.arrays[self.mask_key][idx]
+
+        if self.keep_packed:
+            return self.packed_item(img, mask)
+        if self.width is not None:
+            mask = unpack_masks(mask, self.width)
+        return self.stack(img, mask[np.newaxis])
+
+
+class LIDCRaterDataset(PackedDataset):
+    """LIDC slices stored once with all four rater masks, as written by save_LIDC_data.py
+
+    Masks are kept bit-packed, (N, raters, H, ceil(W / 8)), and the target is built per item:
+        'random': one rater drawn at random for every item
+        'soft':   all raters, one target channel each
+        'mean':   mean over the raters
+
+    Items are (H, W, 1 + K) float32 with the image in channel 0 and the K target channels
+    after it, so 'random' and 'mean' are drop-in replacements for the concatenated X arrays.
+    With keep_packed=True the 'mask' entry holds the packed bits of the drawn rater
+    ('random') or of all raters ('soft').
+    """
+
+    modes = ('random', 'soft', 'mean')
+
+    def __init__(self, path: str, mode: str = 'random', keep_packed: bool = False):
+        super().__init__(path, keep_packed=keep_packed)
+        assert mode in self.modes, f'Unknown rater mode {mode}, expected one of {self.modes}'
+        assert not (keep_packed and mode == 'mean'), 'The rater mean cannot be kept bit-packed'
+        self.mode = mode
+        self.n_raters = read_header(self.path)['arrays'][self.mask_key]['shape'][1]
+
+    def __getitem__(self, idx):
+        img = self.arrays[self.image_key][idx]
+        bits = self.arrays[self.mask_key][idx]
+
+        if self.mode == 'random':
+            # torch's generator is reseeded in every DataLoader worker, numpy's is not
+            rater = int(torch.randint(self.n_raters, ()))
+            bits = bits[rater]
+            if self.keep_packed:
+                return self.packed_item(img, bits)
+            target = unpack_masks(bits, self.width)[np.newaxis]
+        else:
+            if self.keep_packed:
+                return self.packed_item(img, bits)
+            target = unpack_masks(bits, self.width)
+            if self.mode == 'mean':
+                target = target.mean(axis=0, keepdims=True)
+
+        return self.stack(img, target)
@@ -1,39 +1,61 @@
+from typing import NamedTuple
+
 import torch
 from torch import Tensor
 
 
+class OverlapScores(NamedTuple):
+    per_sample: Tensor  # (B, C)
+    per_class: Tensor   # (C,)
+    mean: Tensor        # ()
+
+
+def _overlap(input: Tensor, target: Tensor, dims, epsilon=1e-6, iou=False, empty_score=0.0):
+    # Dice (or IoU) reduced over dims with one sum per term, a score of empty_score where the
+    # target is empty, selected on device so nothing waits for the host
+    inter = torch.sum(input * target, dim=dims)
+    target_sum = torch.sum(target, dim=dims)
+    sets_sum = torch.sum(input, dim=dims) + target_sum
+
+    if iou:
+        score = (inter + epsilon) / (sets_sum - inter + epsilon)
+    else:
+        score = (2 * inter + epsilon) / (sets_sum + epsilon)
+    return torch.where(target_sum == 0, torch.full_like(score, empty_score), score)
+
+
+def batch_dice(input: Tensor, target: Tensor, epsilon=1e-6, empty_score=0.0):
+    # Dice of (B, C, H, W) masks per sample and class, per class and overall
+    assert input.size() == target.size() and input.dim() == 4
+    per_sample = _overlap(input, target, (-2, -1), epsilon, empty_score=empty_score)
+    per_class = per_sample.mean(dim=0)
+    return OverlapScores(per_sample, per_class, per_class.mean())
+
+
+def batch_iou(input: Tensor, target: Tensor, epsilon=1e-6, empty_score=0.0):
+    # IoU of (B, C, H, W) masks per sample and class, per class and overall
+    assert input.size() == target.size() and input.dim() == 4
+    per_sample = _overlap(input, target, (-2, -1), epsilon, iou=True, empty_score=empty_score)
+    per_class = per_sample.mean(dim=0)
+    return OverlapScores(per_sample, per_class, per_class.mean())
+
+
 def dice_coeff(input: Tensor, target: Tensor, reduce_batch_first: bool = False, epsilon=1e-6):
     # Average of Dice coefficient for all batches, or for a single mask
+    # (a mask with an empty target scores 0)
     assert input.size() == target.size()
     if input.dim() == 2 and reduce_batch_first:
         raise ValueError(f'Dice: asked to reduce batch but got tensor without batch dimension (shape {input.shape})')
 
-    if input.dim() == 2 or reduce_batch_first:
-        inter = torch.dot(input.view(-1), target.view(-1))
-        sets_sum = torch.sum(input) + torch.sum(target)
-        sets_sum_target = torch.sum(target)
-
-        if sets_sum_target.item() == 0:
-            return 0.0 # return 0 if both masks are empty
-            #sets_sum = 2 * inter
-
-        return (2 * inter + epsilon) / (sets_sum + epsilon)
-    else:
-        # compute and average metric for each batch element
-        dice = 0
-        for i in range(input.shape[0]):
-            dice += dice_coeff(input[i, ...], target[i, ...])
-        return dice / input.shape[0]
+    dims = tuple(range(input.dim())) if reduce_batch_first else (-2, -1)
+    return _overlap(input, target, dims, epsilon).mean()
 
 
 def multiclass_dice_coeff(input: Tensor, target: Tensor, reduce_batch_first: bool = False, epsilon=1e-6):
     # Average of Dice coefficient for all classes
     assert input.size() == target.size()
-    dice = 0
-    for channel in range(input.shape[1]):
-        dice += dice_coeff(input[:, channel, ...], target[:, channel, ...], reduce_batch_first, epsilon)
-
-    return dice / input.shape[1]
+    dims = (0, -2, -1) if reduce_batch_first else (-2, -1)
+    return _overlap(input, target, dims, epsilon).mean()
 
 
 def dice_loss(input: Tensor, target: Tensor, multiclass: bool = False):
@@ -0,0 +1,83 @@
+""" TorchScript / ONNX export of the U-Nets and a CPU runtime for the exported graphs
+
+The networks are exported in inference form: every Conv2d followed by a BatchNorm2d
+is replaced by one convolution with the normalization folded into its weights. The
+exported graphs are traced for a fixed input size, which all our data uses anyway.
+"""
+
+import copy
+import os
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+def fold_batchnorm(net):
+    """Copy of net in eval mode with each Conv2d -> BatchNorm2d pair of an nn.Sequential fused"""
+    net = copy.deepcopy(net).eval()
+    for module in net.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        names = list(module._modules)
+        for name, next_name in zip(names, names[1:]):
+            conv, bn = module._modules[name], module._modules[next_name]
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                module._modules[name] = fuse_conv_bn_eval(conv, bn)
+                module._modules[next_name] = nn.Identity()
+    return net
+
+
+def export_torchscript(net, path, example):
+    with torch.no_grad():
+        traced = torch.jit.trace(fold_batchnorm(net), example)
+        traced = torch.jit.freeze(traced)
+    traced.save(path)
+    return traced
+
+
+def export_onnx(net, path, example, opset_version=17):
+    net = fold_batchnorm(net)
+    with torch.no_grad():
+        output = net(example)
+    n_outputs = len(output) if isinstance(output, (tuple, list)) else 1
+    output_names = [f'head{k}' for k in range(n_outputs)]
+    torch.onnx.export(net, example, path, input_names=['image'], output_names=output_names,
+                      dynamic_axes={name: {0: 'batch'} for name in ['image'] + output_names},
+                      opset_version=opset_version)
+
+
+class ExportedModel:
+    """Runs an exported .pt (TorchScript) or .onnx graph on the CPU with a fixed number of threads
+
+    Called with a (B, C, H, W) float tensor, returns what the eager network returns,
+    a tensor or a tuple of per-head tensors.
+    """
+
+    def __init__(self, path, threads=None):
+        self.path = path
+        self.threads = threads
+        self.onnx = os.path.splitext(path)[1] == '.onnx'
+
+        if self.onnx:
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            if threads:
+                options.intra_op_num_threads = threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+            self.input_name = self.session.get_inputs()[0].name
+        else:
+            if threads:
+                torch.set_num_threads(threads)
+            self.module = torch.jit.load(path, map_location='cpu')
+            self.module.eval()
+
+    def __call__(self, x):
+        if self.onnx:
+            outputs = self.session.run(None, {self.input_name: x.detach().cpu().numpy()})
+            outputs = [torch.from_numpy(output) for output in outputs]
+            return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+        with torch.no_grad():
+            return self.module(x)
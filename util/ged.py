@@ -0,0 +1,72 @@
+""" Generalized energy distance between sampled segmentations and the rater masks
+
+With d(a, b) = 1 - IoU(a, b) (0 when both masks are empty),
+
+    GED^2 = 2 E[d(S, Y)] - E[d(S, S')] - E[d(Y, Y')]
+
+over model samples S and rater masks Y of an image, the expectations being means over
+all pairs (including a mask with itself). E[d(S, S')] is also reported on its own as
+the diversity of the samples. All pairwise intersections of a batch come from one
+batched matmul of the flattened masks.
+"""
+
+import torch
+
+
+def iou_distance(a, b):
+    """(B, N, P) and (B, M, P) binary masks to the (B, N, M) pairwise 1 - IoU distances"""
+    a = a.float()
+    b = b.float()
+    inter = torch.bmm(a, b.transpose(1, 2))
+    union = a.sum(dim=2).unsqueeze(2) + b.sum(dim=2).unsqueeze(1) - inter
+    return torch.where(union > 0, 1 - inter / union.clamp(min=1), torch.zeros_like(inter))
+
+
+def energy_distance_terms(samples, raters):
+    """(B, S, H, W) samples and (B, R, H, W) rater masks to the per-image (B,) GED^2,
+    E[d(S, Y)], E[d(S, S')] and E[d(Y, Y')]"""
+    samples = samples.flatten(2)
+    raters = raters.flatten(2)
+    d_sy = iou_distance(samples, raters).mean(dim=(1, 2))
+    d_ss = iou_distance(samples, samples).mean(dim=(1, 2))
+    d_yy = iou_distance(raters, raters).mean(dim=(1, 2))
+    return 2 * d_sy - d_ss - d_yy, d_sy, d_ss, d_yy
+
+
+class GEDAccumulator:
+    """Streaming mean over images of GED^2 and its terms, kept on the device of the first batch"""
+
+    names = ('ged', 'sample_rater', 'diversity', 'rater_rater')
+
+    def __init__(self):
+        self.sums = None
+        self.sq_sums = None
+        self.count = 0
+
+    def update(self, samples, raters):
+        terms = torch.stack(energy_distance_terms(samples, raters), dim=1).double()
+        if self.sums is None:
+            self.sums = torch.zeros(len(self.names), dtype=torch.float64, device=terms.device)
+            self.sq_sums = torch.zeros_like(self.sums)
+        self.sums += terms.sum(dim=0)
+        self.sq_sums += (terms ** 2).sum(dim=0)
+        self.count += terms.shape[0]
+        return self
+
+    def merge(self, other):
+        if other.sums is None:
+            return self
+        if self.sums is None:
+            self.sums = torch.zeros_like(other.sums)
+            self.sq_sums = torch.zeros_like(other.sums)
+        self.sums += other.sums.to(self.sums.device)
+        self.sq_sums += other.sq_sums.to(self.sums.device)
+        self.count += other.count
+        return self
+
+    def finalize(self):
+        """Mean and standard deviation over the images of every term"""
+        assert self.count, 'No batches were added'
+        mean = self.sums / self.count
+        std = (self.sq_sums / self.count - mean ** 2).clamp(min=0).sqrt()
+        return {name: (m, s) for name, m, s in zip(self.names, mean.tolist(), std.tolist())}
@@ -0,0 +1,62 @@
+""" Several checkpoints of one architecture evaluated together on the same input batch
+
+ModelStack stacks the parameters and buffers of K networks and runs them with
+torch.func.vmap over a single functional copy, so an input batch is transferred once
+and all K outputs come back from one call. Without torch.func (torch < 2.0), or with
+vmap=False, the networks are simply called one after the other on the same batch.
+"""
+
+import copy
+
+import torch
+
+try:
+    from torch.func import functional_call, stack_module_state, vmap
+except ImportError:
+    functional_call = stack_module_state = vmap = None
+
+
+class ModelStack:
+    """K networks with the same architecture and state_dict keys, evaluated in inference mode
+
+    Calling the stack with a (B, ...) batch returns the output structure of a single
+    network (a tensor or a tuple of per-head tensors) with a leading K axis on every
+    tensor, model k being the k-th network passed in.
+    """
+
+    def __init__(self, nets, vmap=True):
+        self.nets = list(nets)
+        assert self.nets, 'ModelStack needs at least one network'
+        keys = set(self.nets[0].state_dict())
+        assert all(set(net.state_dict()) == keys for net in self.nets), 'Networks have different parameters'
+        for net in self.nets:
+            net.eval()
+
+        self.use_vmap = vmap and stack_module_state is not None and len(self.nets) > 1
+        if self.use_vmap:
+            self.params, self.buffers = stack_module_state(self.nets)
+            # only the structure is needed, the weights come from the stacked state
+            self.base = copy.deepcopy(self.nets[0]).to('meta')
+
+    def __len__(self):
+        return len(self.nets)
+
+    def _call(self, params, buffers, x):
+        return functional_call(self.base, (params, buffers), (x,))
+
+    @torch.no_grad()
+    def __call__(self, x):
+        if self.use_vmap:
+            return vmap(self._call, in_dims=(0, 0, None))(self.params, self.buffers, x)
+
+        outputs = [net(x) for net in self.nets]
+        if isinstance(outputs[0], (tuple, list)):
+            return tuple(torch.stack(heads) for heads in zip(*outputs))
+        return torch.stack(outputs)
+
+    @staticmethod
+    def unstack(output, k):
+        """Output of model k, in the structure a single network returns"""
+        if isinstance(output, (tuple, list)):
+            return tuple(head[k] for head in output)
+        return output[k]
@@ -0,0 +1,85 @@
+""" Packed on-disk array format that can be memory-mapped without loading it
+
+Layout of a packed file:
+
+    8 bytes   magic  b'QRSPACK1'
+    8 bytes   little-endian uint64, length of the JSON header
+    N bytes   JSON header {'arrays': {name: {'dtype', 'shape', 'offset'}}, 'meta': {...}}
+    ...       raw C-ordered arrays, each starting on a 4096 byte boundary
+
+Unlike .npz files, every array can be opened with np.memmap, so DataLoader
+workers share the page cache instead of each holding a private copy.
+"""
+
+import json
+import struct
+from pathlib import Path
+
+import numpy as np
+
+MAGIC = b'QRSPACK1'
+ALIGN = 4096
+
+
+def _align(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a packed array file')
+        header_len, = struct.unpack('<Q', f.read(8))
+        return json.loads(f.read(header_len).decode('utf-8'))
+
+
+def create_packed(path, arrays, meta=None):
+    """Preallocate a packed file and return writable memmaps of its arrays
+
+    arrays: dict name -> (shape, dtype)
+    """
+    path = Path(path)
+    header = {'arrays': {}, 'meta': meta or {}}
+    for name, (shape, dtype) in arrays.items():
+        header['arrays'][name] = {'dtype': np.dtype(dtype).str, 'shape': [int(s) for s in shape], 'offset': 0}
+
+    # offsets depend on the header length, so lay the header out once with
+    # placeholders and then fill them in; the reserved space covers both
+    reserved = _align(len(MAGIC) + 8 + len(json.dumps(header)) + 32 * len(arrays))
+    offset = reserved
+    for spec in header['arrays'].values():
+        spec['offset'] = offset
+        offset = _align(offset + int(np.prod(spec['shape'])) * np.dtype(spec['dtype']).itemsize)
+
+    blob = json.dumps(header).encode('utf-8')
+    assert len(MAGIC) + 8 + len(blob) <= reserved, 'Packed header overflowed its reserved space'
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(blob)))
+        f.write(blob)
+        f.truncate(offset)
+
+    return open_packed(path, mode='r+')[0]
+
+
+def open_packed(path, mode='r'):
+    """Memory-map every array of a packed file, returns (arrays, meta)"""
+    header = read_header(path)
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        shape = tuple(spec['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=spec['dtype'])
+            continue
+        arrays[name] = np.memmap(path, dtype=spec['dtype'], mode=mode, offset=spec['offset'], shape=shape)
+    return arrays, header['meta']
+
+
+def save_packed(path, meta=None, chunk=1024, **arrays):
+    """Write in-memory (or memory-mapped) arrays to a packed file"""
+    out = create_packed(path, {name: (a.shape, a.dtype) for name, a in arrays.items()}, meta=meta)
+    for name, a in arrays.items():
+        for start in range(0, len(a), chunk):
+            out[name][start:start + chunk] = a[start:start + chunk]
+        out[name].flush()
+    return path
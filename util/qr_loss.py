@@ -0,0 +1,117 @@
+""" Per-head losses used by the QR U-Net training scripts
+
+Every criterion takes a predicted foreground map f (or probability P), the target
+mask Y and the quantile q of the head, and returns the summed loss. Each is the sum
+of one elementwise function below, which QuantileLoss also uses to compute the same
+losses for all heads at once.
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def _bce_w(P, Y, q):
+    q = 166
+    return -(q*Y*torch.log2(P+1e-16) + (1.0-Y)*torch.log2(1.0-P+1e-16))
+
+
+def _bce(P, Y, q):
+    q = 0.5
+    return -(q*Y*torch.log2(P+1e-16) + (1.0-q)*(1.0-Y)*torch.log2(1.0-P+1e-16))
+
+
+def _bce_sigmoid(P, Y, q):
+    # variant used for the LIDC_4Q_BCE_all model, squashes P once more
+    return _bce(torch.sigmoid(P), Y, q)
+
+
+def _qr_new(f, Y, q):
+    # pinball loss, q*|e| where e < 0 and (1-q)*|e| where e > 0, written elementwise so
+    # there are no data dependent boolean gathers (and no host sync for their size)
+    error = f - Y
+    return torch.maximum(-q*error, (1.0-q)*error)
+
+
+def _qr_smooth(f, Y, q, h=0.01):
+    # pinball loss with the kink at e = 0 smoothed over a width of about h,
+    # -q*e + relu(e) with relu replaced by h*softplus(e/h)
+    error = f - Y
+    return -q*error + F.softplus(error, beta=1.0/h)
+
+
+def _qr(f, Y, q):
+    return -(Y - (1.0-q))*f
+
+
+def _qr_warmup(f, Y, q):
+    return _qr(f, Y, 0.625)
+
+
+def BCEqr_W(P, Y, q):
+    return torch.sum(_bce_w(P, Y, q))
+
+
+def BCEqr(P, Y, q):
+    return torch.sum(_bce(P, Y, q))
+
+
+def BCEqr_sigmoid(P, Y, q):
+    return torch.sum(_bce_sigmoid(P, Y, q))
+
+
+def QRcost_new(f, Y, q=0.5):
+    return torch.sum(_qr_new(f, Y, q))
+
+
+def QRcost_smooth(f, Y, q=0.5, h=0.01):
+    return torch.sum(_qr_smooth(f, Y, q, h))
+
+
+def QRcost_warmup(f, Y, q=0.5, h=0.1):
+    return torch.sum(_qr_warmup(f, Y, q))
+
+
+def QRcost(f, Y, q=0.5, h=0.1):
+    return torch.sum(_qr(f, Y, q))
+
+
+criteria = {
+    'qr': QRcost,
+    'qr_new': QRcost_new,
+    'qr_smooth': QRcost_smooth,
+    'qr_warmup': QRcost_warmup,
+    'bce': BCEqr,
+    'bce_w': BCEqr_W,
+    'bce_sigmoid': BCEqr_sigmoid,
+}
+
+
+class QuantileLoss(nn.Module):
+    """Sum of one of the criteria above over all quantile heads in a single broadcasted pass
+
+    forward takes the stacked (B, Q, H, W) foreground predictions and the (B, H, W)
+    target and equals sum_k criteria[kind](pred[:, k], target, q=quantiles[k]),
+    including the fixed q the BCE and warmup criteria use whatever head they are given.
+    """
+
+    elementwise = {
+        'qr': _qr,
+        'qr_new': _qr_new,
+        'qr_smooth': _qr_smooth,
+        'qr_warmup': _qr_warmup,
+        'bce': _bce,
+        'bce_w': _bce_w,
+        'bce_sigmoid': _bce_sigmoid,
+    }
+
+    def __init__(self, quantiles, kind='qr'):
+        super().__init__()
+        assert kind in self.elementwise, f'Unknown loss {kind}, expected one of {list(self.elementwise)}'
+        self.kind = kind
+        self.register_buffer('q', torch.tensor(quantiles, dtype=torch.float32).view(1, -1, 1, 1))
+
+    def forward(self, pred, target):
+        assert pred.shape[1] == self.q.shape[1], \
+            f'Got {pred.shape[1]} prediction heads for {self.q.shape[1]} quantiles'
+        return torch.sum(self.elementwise[self.kind](pred, target.unsqueeze(1), self.q))
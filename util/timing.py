@@ -0,0 +1,37 @@
+""" Wall-clock timing shared by the bench_*.py scripts
+
+CUDA kernels run asynchronously, so the device is synchronized before the clock is
+started and read, and peak memory is measured from the allocations at the start.
+"""
+
+import time
+
+import torch
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_call(fn, repeats, device=torch.device('cpu'), warmup=3):
+    """Milliseconds per call of fn() and its peak CUDA memory in MiB (nan on the CPU)
+
+    fn is called warmup times untimed, then repeats times. The peak is what fn
+    allocated on top of the memory already in use before the timed calls.
+    """
+    for _ in range(warmup):
+        fn()
+    sync(device)
+
+    cuda = device.type == 'cuda'
+    if cuda:
+        torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device) if cuda else 0
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    sync(device)
+    ms = (time.perf_counter() - start) / repeats * 1e3
+    peak = (torch.cuda.max_memory_allocated(device) - base) / 2**20 if cuda else float('nan')
+    return ms, peak
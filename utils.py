@@ -25,6 +25,17 @@ def init_weights_orthogonal_normal(m):
         truncated_normal_(m.bias, mean=0, std=0.001)
         #nn.init.normal_(m.bias, std=0.001)
 
+def build_from_checkpoint(cls, path, device='cpu', **kwargs):
+    """
+    Construct cls(**kwargs) on the meta device, where allocation and weight initialization cost nothing,
+    then allocate the parameters on device and load the state_dict saved in path.
+    """
+    with torch.device('meta'):
+        net = cls(**kwargs)
+    net = net.to_empty(device=device)
+    net.load_state_dict(torch.load(path, map_location=device))
+    return net
+
 def l2_regularisation(m):
     l2_reg = None
 